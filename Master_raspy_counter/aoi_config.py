@@ -0,0 +1,21 @@
+import json
+import os
+
+# AOI/lane layout shared by the counter GUI and the detector
+AOI_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aoi_config.json")
+
+def load_aoi_config(path=AOI_CONFIG_PATH):
+    """Load the AOI layout: {"frame_size": [w, h], "aois": [{"name": ..., "box": [x, y, w, h]}, ...]}."""
+    with open(path, "r") as f:
+        config = json.load(f)
+    if not config.get("aois"):
+        raise ValueError(f"No AOIs in {path}")
+    config.setdefault("frame_size", [640, 480])
+    return config
+
+def aoi_band(config, margin=0):
+    """Vertical band (y0, y1) covering every AOI plus margin, clamped to the frame."""
+    frame_h = config["frame_size"][1]
+    y0 = min(aoi["box"][1] for aoi in config["aois"]) - margin
+    y1 = max(aoi["box"][1] + aoi["box"][3] for aoi in config["aois"]) + margin
+    return max(0, y0), min(frame_h, y1)
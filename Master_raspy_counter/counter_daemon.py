@@ -0,0 +1,271 @@
+"""Headless counter daemon serving many detector feeds from one selectors loop.
+
+Each source in the JSON config gets its own CountingEngine and checkpoint;
+all of them report through one shared pass-event outbox:
+
+    {
+        "sources": [
+            {"name": "gate-b-entry", "role": "entry", "address": "/tmp/entry.pipe",
+             "aoi_config": "/home/pi/Master_raspy_counter/aoi_config.json"},
+            {"name": "gate-b-exit", "role": "exit", "address": "tcp://0.0.0.0:7001"}
+        ]
+    }
+
+address is a named pipe path (created if missing), tcp://host:port or
+unix:///path; sockets accept one detector connection at a time and a newer
+connection replaces the old one. Per-source lag metrics are written to the
+status file.
+"""
+import argparse
+import fcntl
+import json
+import os
+import selectors
+import signal
+import socket
+import stat
+import struct
+import sys
+import termios
+import time
+
+from aoi_config import load_aoi_config
+from counter_checkpoint import CounterCheckpoint, next_boot_epoch
+from counting_engine import CountingEngine
+from detection_stream import is_stream_address, listen_socket, remove_socket_file
+from pass_outbox import PassOutbox
+import sampling_profiler
+
+# Flask server URL (master Pi)
+FLASK_SERVER_URL = "http://192.168.191.34:5000/update_passed"
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+READ_SIZE = 65536
+
+class DetectionSource:
+    """One detector feed (FIFO or listening socket) with its own counting engine."""
+
+    def __init__(self, name, role, address, aois, outbox, state_dir, verbose=False):
+        self.name = name
+        self.role = role
+        self.address = address
+        self.outbox = outbox
+        self.device_id = f"{socket.gethostname()}-{name}"
+        self.pass_seq = 0
+        self.engine = CountingEngine(aois, on_pass=self.send_pass_event, verbose=verbose, name=name)
+        self.checkpoint = CounterCheckpoint(os.path.join(state_dir, f"{name}.bin"), 0)
+        restored = self.checkpoint.restore(self.engine)
+        # Every start gets a larger epoch than any before it, so pass_seq can start again at 1
+        self.boot_epoch = next_boot_epoch(os.path.join(state_dir, f"{name}.boot_epoch"), restored[0] if restored else 0)
+        self.checkpoint.boot_epoch = self.boot_epoch
+        self.listener = None
+        self.conn = None
+        self.fd = None
+        self.buffer = b""
+        # Lag metrics
+        self.frames = 0
+        self.missed_frames = 0
+        self.decode_errors = 0
+        self.process_errors = 0
+        self.bytes_read = 0
+        self.last_frame_at = None
+        self.last_lag = None
+        self.process_ms = 0.0  # Moving average per frame
+
+    def send_pass_event(self, engine):
+        self.pass_seq += 1
+        self.outbox.append({
+            "device_id": self.device_id,
+            "boot_epoch": self.boot_epoch,
+            "seq": self.pass_seq,
+            "role": self.role,
+            "ts": time.time()
+        })
+
+    def open(self, selector):
+        if not is_stream_address(self.address):
+            if not os.path.exists(self.address):
+                os.mkfifo(self.address)
+            elif not stat.S_ISFIFO(os.stat(self.address).st_mode):
+                raise ValueError(f"{self.address} is not a named pipe")
+            # Opening read-write keeps a writer attached, so there is no EOF between detector restarts
+            self.fd = os.open(self.address, os.O_RDWR | os.O_NONBLOCK)
+            selector.register(self.fd, selectors.EVENT_READ, (self, "data"))
+            print(f"{self.name}: reading named pipe {self.address}", file=sys.stderr)
+            return
+        self.listener = listen_socket(self.address)
+        selector.register(self.listener, selectors.EVENT_READ, (self, "accept"))
+        print(f"{self.name}: listening on {self.address}", file=sys.stderr)
+
+    def accept(self, selector):
+        conn, peer = self.listener.accept()
+        conn.setblocking(False)
+        if self.conn is not None:
+            print(f"{self.name}: replacing detector connection", file=sys.stderr)
+            self.disconnect(selector)
+        self.conn = conn
+        self.buffer = b""
+        selector.register(conn, selectors.EVENT_READ, (self, "data"))
+        print(f"{self.name}: detector connected from {peer or 'local socket'}", file=sys.stderr)
+
+    def disconnect(self, selector):
+        selector.unregister(self.conn)
+        self.conn.close()
+        self.conn = None
+
+    def on_readable(self, selector):
+        try:
+            data = self.conn.recv(READ_SIZE) if self.conn is not None else os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print(f"{self.name}: read error: {e}", file=sys.stderr)
+            data = b""
+        if not data:
+            if self.conn is not None:
+                print(f"{self.name}: detector disconnected", file=sys.stderr)
+                self.disconnect(selector)
+            return
+        self.bytes_read += len(data)
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                self.feed(line)
+
+    def feed(self, line):
+        try:
+            frame_data = json.loads(line)
+        except json.JSONDecodeError:
+            self.decode_errors += 1
+            return
+        if not isinstance(frame_data, dict) or "frame" not in frame_data:
+            return
+        start = time.perf_counter()
+        last_frame = self.engine.last_processed_frame
+        try:
+            result = self.engine.process(frame_data)
+        except Exception as e:
+            # A malformed record (a frame number or box that is not a number) skips only itself
+            self.process_errors += 1
+            print(f"{self.name}: Error processing frame {frame_data.get('frame')!r}: {e!r}", file=sys.stderr)
+            return
+        if last_frame != -1 and result.frame > last_frame + 1:
+            self.missed_frames += result.frame - last_frame - 1
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.process_ms = elapsed_ms if self.frames == 0 else 0.95 * self.process_ms + 0.05 * elapsed_ms
+        self.frames += 1
+        self.last_frame_at = time.time()
+        if isinstance(frame_data.get("timestamp"), (int, float)):
+            self.last_lag = self.last_frame_at - frame_data["timestamp"]
+        self.checkpoint.maybe_save(self.engine, self.pass_seq, force=result.passed)
+
+    def pending_bytes(self):
+        """Bytes written by the detector but not yet read."""
+        fileobj = self.conn.fileno() if self.conn is not None else self.fd
+        if fileobj is None:
+            return 0
+        try:
+            return struct.unpack("i", fcntl.ioctl(fileobj, termios.FIONREAD, b"\0\0\0\0"))[0] + len(self.buffer)
+        except OSError:
+            return len(self.buffer)
+
+    def metrics(self):
+        now = time.time()
+        return {
+            "role": self.role,
+            "address": self.address,
+            "connected": self.fd is not None or self.conn is not None,
+            "state": self.engine.current_state,
+            "total_cars_passed": self.engine.total_cars_passed,
+            "frames": self.frames,
+            "missed_frames": self.missed_frames,
+            "decode_errors": self.decode_errors,
+            "process_errors": self.process_errors,
+            "bytes_read": self.bytes_read,
+            "pending_bytes": self.pending_bytes(),
+            "last_frame_age_s": round(now - self.last_frame_at, 3) if self.last_frame_at else None,
+            "lag_s": round(self.last_lag, 3) if self.last_lag is not None else None,
+            "process_ms": round(self.process_ms, 3)
+        }
+
+    def close(self, selector):
+        self.checkpoint.save(self.engine, self.pass_seq)
+        for fileobj in (self.conn, self.listener):
+            if fileobj is not None:
+                selector.unregister(fileobj)
+                fileobj.close()
+        if self.fd is not None:
+            selector.unregister(self.fd)
+            os.close(self.fd)
+        remove_socket_file(self.address)
+
+def write_status(path, sources, outbox):
+    status = {
+        "time": time.time(),
+        "outbox": outbox.stats(),
+        "sources": {source.name: source.metrics() for source in sources}
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, path)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Count cars for many detector feeds in one process")
+    parser.add_argument("--config", required=True, help="JSON file listing the detection sources")
+    parser.add_argument("--server-url", default=FLASK_SERVER_URL, help="Master /update_passed URL")
+    parser.add_argument("--state-dir", default=BASE_DIR, help="Directory for checkpoints and the outbox")
+    parser.add_argument("--status-file", default="/tmp/counter_daemon_status.json", help="Per-source metrics output")
+    parser.add_argument("--status-interval", type=float, default=5.0, help="Seconds between status updates")
+    parser.add_argument("--verbose", action="store_true", help="Log every frame like the GUI counter")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    with open(args.config, "r") as f:
+        config = json.load(f)
+
+    outbox = PassOutbox(os.path.join(args.state_dir, "counter_daemon_outbox.db"), args.server_url)
+    outbox.start()
+    selector = selectors.DefaultSelector()
+    sources = []
+    for entry in config["sources"]:
+        aois = load_aoi_config(entry.get("aoi_config", os.path.join(BASE_DIR, "aoi_config.json")))["aois"]
+        source = DetectionSource(entry["name"], entry["role"], entry["address"], aois, outbox,
+                                 args.state_dir, args.verbose)
+        source.open(selector)
+        sources.append(source)
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    sampling_profiler.install("counter-daemon")
+    next_status = time.monotonic()
+    try:
+        while running:
+            for key, _ in selector.select(timeout=max(0.0, next_status - time.monotonic())):
+                source, kind = key.data
+                if kind == "accept":
+                    source.accept(selector)
+                else:
+                    source.on_readable(selector)
+            if time.monotonic() >= next_status:
+                next_status = time.monotonic() + args.status_interval
+                try:
+                    write_status(args.status_file, sources, outbox)
+                except OSError as e:
+                    print(f"Error writing status file: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Shutting down...", file=sys.stderr)
+    finally:
+        for source in sources:
+            source.close(selector)
+        outbox.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Counting accuracy on synthetic traffic at several frame rates.
+
+Drives the counting engine with the synthetic traffic generator at each
+frame rate and compares its count with the generator's ground truth, so a
+change to the tracking or the state machine can be checked at the reduced
+rates the detector falls back to under load. A seed gives the same cars at
+every rate, so differences between rates come from the sampling alone.
+
+    python counting_accuracy.py                       # 30, 15 and 10 fps, seeds 1 and 2
+    python counting_accuracy.py --fps 10 5 --seeds 1 2 3 --speed 600 1000
+    python counting_accuracy.py --min-accuracy 0.5    # exit 1 if any run counts less than half
+
+Accuracy is the engine's count over the ground truth count.
+"""
+import argparse
+import json
+import sys
+import time
+
+from aoi_config import AOI_CONFIG_PATH, aoi_band, load_aoi_config
+from counting_engine import CountingEngine
+from synthetic_traffic import TrafficSimulator
+from synthetic_traffic import get_args as traffic_args
+
+def count_run(layout, fps, seed, options):
+    """Count one simulated run; return (ground truth count, engine count, engine seconds per frame)."""
+    sim_args = traffic_args(["--fps", str(fps), "--seed", str(seed), "--speed", *map(str, options.speed)])
+    sim_args.frame_size = layout["frame_size"]
+    sim = TrafficSimulator(sim_args, aoi_band(layout))
+    engine = CountingEngine(layout["aois"], verbose=False)
+    frames = int(options.duration * fps)
+    engine_time = 0.0
+    for _ in range(frames):
+        record = {"frame": sim.frame + 1, "timestamp": sim.frame / fps + 1.0, "detections": sim.step()}
+        start = time.perf_counter()
+        engine.process(record)
+        engine_time += time.perf_counter() - start
+    return sim.ground_truth()["expected_count"], engine.total_cars_passed, engine_time / frames
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Compare counts with synthetic ground truth at several frame rates")
+    parser.add_argument("--fps", type=float, nargs="+", default=[30, 15, 10], help="Frame rates to simulate")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1, 2], help="Traffic seeds, one run each")
+    parser.add_argument("--duration", type=float, default=1800, help="Simulated seconds per run")
+    parser.add_argument("--speed", type=float, nargs=2, default=(300, 700), metavar=("MIN", "MAX"),
+                        help="Driving speed range in px/s")
+    parser.add_argument("--aoi-config", default=AOI_CONFIG_PATH, help="AOI layout the cars drive through")
+    parser.add_argument("--min-accuracy", type=float, help="Exit with status 1 if any run's accuracy is below this")
+    parser.add_argument("--output", help="Also write the results as JSON here")
+    return parser.parse_args()
+
+def main():
+    options = get_args()
+    layout = load_aoi_config(options.aoi_config)
+    results = []
+    print(f"{'fps':>5} {'seed':>5} {'truth':>6} {'count':>6} {'accuracy':>9} {'us/frame':>9}")
+    for fps in options.fps:
+        for seed in options.seeds:
+            truth, count, engine_time = count_run(layout, fps, seed, options)
+            accuracy = count / truth if truth else 1.0
+            results.append({"fps": fps, "seed": seed, "truth": truth, "count": count,
+                            "accuracy": round(accuracy, 3), "us_per_frame": round(engine_time * 1e6, 2)})
+            print(f"{fps:>5g} {seed:>5} {truth:>6} {count:>6} {accuracy:>9.3f} {engine_time * 1e6:>9.1f}")
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({"speed": list(options.speed), "duration": options.duration, "results": results}, f, indent=2)
+    if options.min_accuracy is not None:
+        low = [result for result in results if result["accuracy"] < options.min_accuracy]
+        if low:
+            print(f"Accuracy below {options.min_accuracy} in {len(low)} runs", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
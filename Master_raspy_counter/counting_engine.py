@@ -0,0 +1,428 @@
+import sys
+
+from counter_checkpoint import rebase_frames
+
+# picamera2's default IMX500 inference rate, at which the counting thresholds were tuned in frames
+REFERENCE_FPS = 30
+
+NO_DETECTIONS = ()
+
+class FrameResult:
+    """Outcome of one frame: cars drawn, AOI activity and the state after the frame.
+
+    The engine reuses one FrameResult, and its aoi_states list, for every
+    frame, so read it before the next process() call.
+    """
+
+    __slots__ = ("frame", "num_cars", "cars", "aoi_states", "state", "passed")
+
+    def __init__(self, frame, num_cars, cars, aoi_states, state, passed):
+        self.frame = frame
+        self.num_cars = num_cars
+        self.cars = cars
+        self.aoi_states = aoi_states
+        self.state = state
+        self.passed = passed
+
+class Track:
+    """A tracked car. The engine owns one Track per slot and updates it in place every frame."""
+
+    __slots__ = ("number", "id", "bbox", "last_seen_frame", "absent_time", "in_aoi", "aoi_names")
+
+    def __init__(self, number, aoi_names):
+        self.number = number  # 1 or 2, as the GUIs label the cars
+        self.id = 0
+        self.bbox = [0.0, 0.0, 0.0, 0.0]
+        self.last_seen_frame = 0
+        self.absent_time = 0.0
+        self.in_aoi = [False] * len(aoi_names)
+        self.aoi_names = aoi_names
+
+    @property
+    def active_aois(self):
+        """Names of the AOIs the car overlaps this frame (builds a new list, for display)."""
+        return [name for name, active in zip(self.aoi_names, self.in_aoi) if active]
+
+    def __repr__(self):
+        return (f"Track(id={self.id}, bbox={self.bbox}, last_seen_frame={self.last_seen_frame}, "
+                f"absent_time={self.absent_time:.2f}, active_aois={self.active_aois})")
+
+class CountingEngine:
+    """Car tracking and the counting state machine for one gate camera, independent of any GUI.
+
+    Feed it one detection record ({"frame": N, "timestamp": T, "detections":
+    [...]}) per frame with process(). on_pass is called with the engine every
+    time a car is counted.
+
+    Timing rules are durations in seconds on the engine clock, which follows
+    the record timestamps. Records without a timestamp, or whose timestamp
+    goes backwards, advance it by the frame number difference at
+    reference_fps. Comparisons allow half a reference frame of jitter, so
+    the defaults (the frame counts the gates were tuned with, at 30 fps)
+    behave exactly as before at that rate, and keep their meaning in time at
+    any other rate:
+
+    overlap_threshold: box overlap for merging two detections and keeping a track
+    absent_time: how long a track may be missing before it is cleared (6 frames)
+    empty_timeout: time without detections before probable_pass gives up (6 frames)
+    night_pass_empty_time: time without detections that completes a night pass (7 frames)
+    aoi_persist_time: how long an AOI stays active after a car leaves it (5 frames)
+    confirm_time: how long a condition must hold before a transition (5 frames)
+
+    The per-frame working set (the two tracks, the candidate boxes, the AOI
+    flags and the FrameResult) is allocated once and updated in place, and
+    new tracks take the next integer id, so a steady-state frame allocates
+    nothing for the garbage collector to chase. test_counting_allocations.py
+    checks this with tracemalloc, as does every micro_benchmarks.py run.
+    """
+
+    def __init__(self, aois, on_pass=None, verbose=True, name="", overlap_threshold=0.5,
+                 absent_time=6 / REFERENCE_FPS, empty_timeout=6 / REFERENCE_FPS,
+                 night_pass_empty_time=7 / REFERENCE_FPS, aoi_persist_time=5 / REFERENCE_FPS,
+                 confirm_time=5 / REFERENCE_FPS, reference_fps=REFERENCE_FPS):
+        self.aois = aois
+        self.on_pass = on_pass
+        self.verbose = verbose
+        self.name = name
+        self.overlap_threshold = overlap_threshold
+        self.absent_time = absent_time
+        self.empty_timeout = empty_timeout
+        self.night_pass_empty_time = night_pass_empty_time
+        self.aoi_persist_time = aoi_persist_time
+        self.confirm_time = confirm_time
+        self.reference_fps = reference_fps
+        self.tolerance = 0.5 / reference_fps
+        self.current_state = "zero_cars"
+        aoi_names = [aoi["name"] for aoi in aois]
+        self.aoi_boxes = [aoi["box"] for aoi in aois]
+        # A missing AOI name maps to the spare flag at the end of Track.in_aoi, which is never set
+        self.left_aoi, self.middle_aoi, self.right_aoi = (
+            aoi_names.index(name) if name in aoi_names else len(aois) for name in ("Left", "Middle", "Right")
+        )
+        self.tracks = (Track(1, aoi_names), Track(2, aoi_names))
+        for track in self.tracks:
+            track.in_aoi.append(False)
+        self.next_track_id = 1
+        self.car1_data = None  # self.tracks[0] while car 1 is tracked
+        self.car2_data = None  # self.tracks[1] while car 2 is tracked
+        # Candidate boxes of the frame: the two leftmost detections, rounded
+        self.boxes = [[0.0] * 4, [0.0] * 4]
+        # FrameResult.cars for each combination of tracked cars
+        self.car_lists = ((), (self.tracks[0],), (self.tracks[1],), self.tracks)
+        self.result = FrameResult(0, 0, (), [False] * len(aois), self.current_state, False)
+        self.clock = 0.0
+        self.aoi_active_times = [0.0] * len(aois)
+        self.current_frame = 0
+        self.total_cars_passed = 0
+        self.probable_pass_start_time = 0.0
+        self.right_active_since = 0.0
+        self.empty_frame_count = 0
+        self.empty_duration = 0.0
+        self.one_car_frame_count = 0
+        self.one_car_duration = 0.0
+        self.last_processed_frame = -1
+
+    def log(self, message):
+        if self.verbose:
+            print(f"{self.name}: {message}" if self.name else message, file=sys.stderr)
+
+    def count_pass(self):
+        self.total_cars_passed += 1
+        if self.on_pass is not None:
+            self.on_pass(self)
+
+    def at_least(self, duration, threshold):
+        return duration >= threshold - self.tolerance
+
+    def longer_than(self, duration, threshold):
+        return duration > threshold + self.tolerance
+
+    def advance_clock(self, frame_data, frames_elapsed):
+        """Move the engine clock to this record's time and return the seconds since the previous record."""
+        previous = self.clock
+        timestamp = frame_data.get("timestamp")
+        if isinstance(timestamp, (int, float)) and timestamp > self.clock:
+            self.clock = float(timestamp)
+        elif self.last_processed_frame == -1:
+            self.clock = max(frame_data["frame"], 1) / self.reference_fps
+        else:
+            self.clock += frames_elapsed / self.reference_fps
+        return self.clock - previous if previous else frames_elapsed / self.reference_fps
+
+    def matches(self, track, bbox):
+        """True if bbox continues the track: it overlaps the track's last box."""
+        return bool(track) and rectangles_overlap(bbox, track.bbox) > self.overlap_threshold
+
+    def select_cars(self, detections):
+        """Round the two leftmost car boxes into self.boxes and return how many cars were detected."""
+        first = second = None
+        first_x = second_x = 0.0
+        count = 0
+        for item in detections:
+            if isinstance(item, dict) and "label" in item and item["label"] in ("car", "Service_car"):
+                bbox = item.get("bbox")
+                if bbox and len(bbox) == 4:
+                    count += 1
+                    x = round(bbox[0], 1)
+                    # Stable, like the sort by x it replaces: ties keep detection order
+                    if first is None or x < first_x:
+                        second, second_x = first, first_x
+                        first, first_x = bbox, x
+                    elif second is None or x < second_x:
+                        second, second_x = bbox, x
+        if first is not None:
+            round_box(self.boxes[0], first)
+        if second is not None:
+            round_box(self.boxes[1], second)
+        return count
+
+    def update_track(self, slot, track, bbox, matched, frame_interval):
+        """Carry a slot's track into this frame; return (track or None, whether it was cleared as absent).
+
+        A matched detection moves the track. Otherwise a track that was not
+        seen ages by frame_interval and is cleared once absent long enough; a
+        detection that matched nothing starts a new track only in an empty slot.
+        """
+        if matched:
+            copy_box(track.bbox, bbox)
+            track.last_seen_frame = self.current_frame
+            track.absent_time = 0.0
+            return track, False
+        if track:
+            track.absent_time += frame_interval
+            if self.at_least(track.absent_time, self.absent_time):
+                if self.verbose:
+                    self.log(f"Frame {self.current_frame}: Clearing Car{slot + 1}, absent for {track.absent_time:.2f}s")
+                return None, True
+            return track, False
+        if bbox is None:
+            return None, False
+        track = self.tracks[slot]
+        track.id = self.next_track_id
+        self.next_track_id += 1
+        copy_box(track.bbox, bbox)
+        track.last_seen_frame = self.current_frame
+        track.absent_time = 0.0
+        return track, False
+
+    def process(self, frame_data):
+        """Run one detection record through tracking and the state machine; the result is reused by the next call."""
+        total_before = self.total_cars_passed
+        json_frame_number = frame_data["frame"]
+
+        # Detector restarted or state restored from a checkpoint: move stored frame numbers onto the new frame counter
+        if self.last_processed_frame != -1 and json_frame_number <= self.last_processed_frame:
+            rebase_frames(self, json_frame_number - self.last_processed_frame - 1)
+        self.current_frame = json_frame_number
+
+        # Handle frame gaps
+        frames_elapsed = 1
+        if self.last_processed_frame != -1 and json_frame_number > self.last_processed_frame + 1:
+            gap = json_frame_number - self.last_processed_frame - 1
+            self.empty_frame_count += gap
+            frames_elapsed += gap
+        elapsed = self.advance_clock(frame_data, frames_elapsed)
+        # Track absence and one-car time grow by one frame interval per record, as their frame counts did;
+        # only the empty time also covers the frames skipped in a gap
+        frame_interval = elapsed / frames_elapsed
+        now = self.clock
+        self.last_processed_frame = json_frame_number
+
+        # Extract detections, keeping the two leftmost; two that overlap are one car
+        detections = frame_data.get("detections", NO_DETECTIONS)
+        detected = self.select_cars(detections)
+        box1, box2 = self.boxes
+        if detected == 2 and rectangles_overlap(box1, box2) > self.overlap_threshold:
+            box1 = box2
+            raw_num_cars = 1
+        else:
+            raw_num_cars = min(detected, 2)
+        if self.verbose:
+            self.log(f"Frame {json_frame_number}: Raw cars: {describe_cars(detections)}")
+            self.log(f"Frame {json_frame_number}: Cleaned cars: {[box1, box2][:raw_num_cars]}")
+        if raw_num_cars < 2:
+            box2 = None
+            if raw_num_cars == 0:
+                box1 = None
+
+        # Track cars
+        matched1 = box1 is not None and self.matches(self.car1_data, box1)
+        matched2 = box2 is not None and self.matches(self.car2_data, box2)
+        self.car1_data, not_active_obj_car1 = self.update_track(0, self.car1_data, box1, matched1, frame_interval)
+        self.car2_data, not_active_obj_car2 = self.update_track(1, self.car2_data, box2, matched2, frame_interval)
+
+        # Update empty_frame_count and empty_duration based on raw detections
+        if raw_num_cars == 0:
+            self.empty_frame_count += 1
+            self.empty_duration += elapsed
+            self.one_car_frame_count = 0
+        elif raw_num_cars == 1:
+            self.one_car_frame_count += 1
+            self.empty_frame_count = 0
+            self.empty_duration = 0.0
+        else:
+            self.one_car_frame_count = 0
+            self.empty_frame_count = 0
+            self.empty_duration = 0.0
+
+        num_cars = 0
+        if self.car1_data:
+            num_cars += 1
+        if self.car2_data:
+            num_cars += 2
+        cars = self.car_lists[num_cars]
+        num_cars = len(cars)
+
+        if num_cars == 1:
+            self.one_car_duration += frame_interval
+        else:
+            self.one_car_duration = 0.0
+        if self.verbose:
+            self.log(f"Frame {json_frame_number}: Final num_cars: {num_cars}")
+
+        # Update AOI states based on car positions
+        aoi_states = self.result.aoi_states
+        for i in range(len(aoi_states)):
+            aoi_states[i] = False
+        for car in cars:
+            in_aoi = car.in_aoi
+            for i, aoi_box in enumerate(self.aoi_boxes):
+                in_aoi[i] = rectangles_overlap(car.bbox, aoi_box) > 0
+                if in_aoi[i]:
+                    aoi_states[i] = True
+                    self.aoi_active_times[i] = now
+
+        # Persist AOI states for aoi_persist_time
+        for i in range(len(aoi_states)):
+            if not self.longer_than(now - self.aoi_active_times[i], self.aoi_persist_time):
+                aoi_states[i] = True
+
+        car1, car2 = self.car1_data, self.car2_data
+        left, middle, right = self.left_aoi, self.middle_aoi, self.right_aoi
+        new_state = self.current_state
+        match self.current_state:
+            case "zero_cars":
+                if num_cars == 1:
+                    new_state = "one_car"
+                elif num_cars == 2:
+                    new_state = "two_cars"
+            case "one_car":
+                if num_cars == 0 and not car1:
+                    new_state = "zero_cars"
+                elif num_cars == 2:
+                    new_state = "two_cars"
+                elif (car1 and car1.in_aoi[left] and car1.in_aoi[middle] and car1.in_aoi[right] and
+                      sum(car1.in_aoi) == 3):
+                    new_state = "night_pass"
+                elif car1 and car1.in_aoi[left]:
+                    new_state = "left_state"
+                elif car1 and car1.in_aoi[right]:
+                    new_state = "right_state"
+            case "night_pass":
+                if num_cars == 0 and self.at_least(self.empty_duration, self.night_pass_empty_time):
+                    self.count_pass()
+                    new_state = "zero_cars"
+                    self.log(f"Frame {json_frame_number}: Exiting night_pass, car passed")
+            case "two_cars":
+                if self.at_least(self.one_car_duration, self.confirm_time) and car1:
+                    if self.longer_than(now - self.aoi_active_times[2], self.confirm_time):
+                        new_state = "probable_pass"
+                    elif self.longer_than(now - self.aoi_active_times[0], self.confirm_time):
+                        self.count_pass()
+                        new_state = "probable_pass"
+            case "right_state":
+                if num_cars == 0 and not car1:
+                    new_state = "zero_cars"
+                elif car2 and (car2.in_aoi[left] or car2.in_aoi[middle]) and num_cars > 1:
+                    new_state = "2_cars_left"
+                elif self.longer_than(now - self.aoi_active_times[2], self.confirm_time):
+                    new_state = "zero_cars"
+                elif car1 and (car1.in_aoi[left] or car1.in_aoi[middle]) and num_cars <= 1:
+                    if self.probable_pass_start_time == 0:
+                        self.probable_pass_start_time = now
+                    elif self.longer_than(now - self.probable_pass_start_time, self.confirm_time):
+                        new_state = "probable_pass"
+                else:
+                    self.probable_pass_start_time = 0.0
+            case "left_state":
+                if self.longer_than(now - self.aoi_active_times[0], self.confirm_time):
+                    new_state = "zero_cars"
+                elif car2 and (car2.in_aoi[right] or car2.in_aoi[middle]) and num_cars > 1:
+                    new_state = "2_cars_left"
+            case "probable_pass":
+                if num_cars == 0 or not_active_obj_car1:
+                    if self.probable_pass_start_time == 0:
+                        self.probable_pass_start_time = now
+                    elif self.longer_than(now - self.probable_pass_start_time, self.confirm_time):
+                        self.count_pass()
+                        new_state = "zero_cars"
+                        self.probable_pass_start_time = 0.0
+                        self.log(f"Frame {json_frame_number}: Exiting probable_pass, car passed")
+                elif num_cars == 2 and car2 and car2.in_aoi[right]:
+                    if self.right_active_since == 0:
+                        self.right_active_since = now
+                    elif self.longer_than(now - self.right_active_since, self.confirm_time):
+                        new_state = "two_cars"
+                        self.right_active_since = 0.0
+                else:
+                    if self.at_least(self.empty_duration, self.empty_timeout):
+                        if self.verbose:
+                            self.log(f"Frame {json_frame_number}: Timing out probable_pass, no detections for {self.empty_duration:.2f}s")
+                        new_state = "zero_cars"
+                        self.probable_pass_start_time = 0.0
+                        self.car1_data = None
+                        self.car2_data = None
+                    else:
+                        self.right_active_since = 0.0
+            case "2_cars_left":
+                if self.at_least(self.one_car_duration, self.confirm_time) and car1:
+                    if car1.in_aoi[left]:
+                        new_state = "left_state"
+                    elif car1.in_aoi[right]:
+                        new_state = "probable_pass"
+
+        if new_state != self.current_state and self.verbose:
+            self.log(f"Frame {json_frame_number}: State transition from {self.current_state} to {new_state}")
+        self.current_state = new_state
+
+        if self.verbose:
+            self.log(f"Frame {json_frame_number}: {num_cars} cars, State: {new_state}, Car1: {self.car1_data}, Car2: {self.car2_data}, AOI States: {aoi_states}, Total Passed: {self.total_cars_passed}")
+
+        result = self.result
+        result.frame = json_frame_number
+        result.num_cars = num_cars
+        result.cars = cars
+        result.state = new_state
+        result.passed = self.total_cars_passed != total_before
+        return result
+
+def describe_cars(detections):
+    """The car boxes of a detection list, rounded, for the verbose log."""
+    return [{"bbox": [round(coord, 1) for coord in item["bbox"]]} for item in detections
+            if isinstance(item, dict) and item.get("label") in ("car", "Service_car") and
+            item.get("bbox") and len(item["bbox"]) == 4]
+
+def round_box(dst, src):
+    dst[0] = round(src[0], 1)
+    dst[1] = round(src[1], 1)
+    dst[2] = round(src[2], 1)
+    dst[3] = round(src[3], 1)
+
+def copy_box(dst, src):
+    dst[0] = src[0]
+    dst[1] = src[1]
+    dst[2] = src[2]
+    dst[3] = src[3]
+
+def rectangles_overlap(box1, box2):
+    x1, y1, w1, h1 = box1
+    x2, y2, w2, h2 = box2
+    if x1 + w1 < x2 or x1 > x2 + w2 or y1 + h1 < y2 or y1 > y2 + h2:
+        return 0.0
+    x_left = max(x1, x2)
+    x_right = min(x1 + w1, x2 + w2)
+    y_top = max(y1, y2)
+    y_bottom = min(y1 + h1, y2 + h2)
+    overlap_area = (x_right - x_left) * (y_bottom - y_top)
+    area1 = w1 * h1
+    return overlap_area / area1 if area1 > 0 else 0.0
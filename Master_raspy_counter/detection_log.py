@@ -0,0 +1,45 @@
+import gzip
+import json
+import os
+import sys
+import time
+
+class DetectionRecorder:
+    """Append detection records to <root>/<device>/<YYYY-MM-DD>.jsonl, one file per local day.
+
+    Writes go through a normal buffered file; a crash loses at most the last
+    buffer of frames, which only matters for offline recounts.
+    """
+
+    def __init__(self, root, device):
+        self.dir = os.path.join(root, device)
+        os.makedirs(self.dir, exist_ok=True)
+        self.day = None
+        self.file = None
+
+    def write(self, line, ts=None):
+        """Write one serialized record (bytes ending in a newline)."""
+        day = time.strftime("%Y-%m-%d", time.localtime(ts))
+        if day != self.day:
+            self.close()
+            self.file = open(os.path.join(self.dir, f"{day}.jsonl"), "ab")
+            self.day = day
+        self.file.write(line)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def iter_records(path):
+    """Yield detection records from a .jsonl or .jsonl.gz log, skipping malformed lines."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line in {path}", file=sys.stderr)
+                continue
+            if isinstance(record, dict) and "frame" in record:
+                yield record
@@ -2,25 +2,57 @@ import argparse
 import json
 import sys
 import os
+import resource
+import socket
+import threading
 import time
+from contextlib import contextmanager
 
-import cv2
 import numpy as np
 
-from picamera2 import MappedArray, Picamera2
-from picamera2.devices import IMX500
-from picamera2.devices.imx500 import NetworkIntrinsics
+try:
+    import cv2
+except ImportError:
+    cv2 = None  # Only needed to draw the preview overlay
+
+from aoi_config import AOI_CONFIG_PATH, aoi_band, load_aoi_config
+from camera_backend import TensorRecording, load_backend
+from detection_log import DetectionRecorder
+from detection_stream import DetectionStreamWriter
+from stage_pipeline import DROP_POLICIES, Stage, StageQueue, StageTimer
+import sampling_profiler
 
 last_detections = []
 frame_counter = 0  # Track frame number
+frame_timestamp = None  # Capture time of the frame being emitted by the pipeline (else emit time is used)
 pipe_fd = None  # File descriptor for named pipe
+roi_band = None  # (y0, y1) AOI band; detections outside it are dropped
+recorder = None  # DetectionRecorder when --record-dir is set
+stream_writer = None  # DetectionStreamWriter when --stream is set
+tensor_recording = None  # TensorRecording when --record-tensors is set
+backend = None  # Camera backend (picamera2 or simulated), chosen in main()
+stop_event = threading.Event()  # Set to stop the main loop when running in-process
+startup_timings = {}  # Startup phase name -> seconds
+
+# Coordinate space the counter's AOIs are defined in; boxes are scaled to it from the main stream
+COUNTER_FRAME_SIZE = (640, 480)
+box_scale = (1.0, 1.0)
+
+# Camera pipeline profiles: preview configuration plus preview window and overlay drawing
+CAMERA_PROFILES = {
+    "minimal-latency": {"buffer_count": 4, "main_size": (320, 240), "queue": False, "preview": False, "draw": False},
+    "headless": {"buffer_count": 6, "main_size": (320, 240), "queue": True, "preview": False, "draw": False},
+    "debug": {"buffer_count": 12, "main_size": (640, 480), "queue": True, "preview": True, "draw": True},
+}
 
 class Detection:
     def __init__(self, coords, category, conf, metadata):
         """Create a Detection object, recording the bounding box, category and confidence."""
         self.category = category
         self.conf = conf
-        self.box = imx500.convert_inference_coords(coords, metadata, picam2)
+        x, y, w, h = imx500.convert_inference_coords(coords, metadata, picam2)
+        sx, sy = box_scale
+        self.box = (x * sx, y * sy, w * sx, h * sy)
 
 def parse_detections(metadata: dict):
     """Parse the output tensor into a number of detected objects, scaled to the ISP output."""
@@ -31,6 +63,8 @@ def parse_detections(metadata: dict):
             return last_detections
 
         input_w, input_h = imx500.get_input_size()
+        if tensor_recording is not None:
+            tensor_recording.add(np_outputs, (input_w, input_h))
         boxes, scores, classes = np_outputs[0][0], np_outputs[1][0], np_outputs[2][0]
 
         if args.bbox_normalization:
@@ -41,16 +75,25 @@ def parse_detections(metadata: dict):
         boxes = np.array_split(boxes, 4, axis=1)
         boxes = zip(*boxes)
 
-        last_detections = [
+        detections = (
             Detection(box, category, score, metadata)
             for box, score, category in zip(boxes, scores, classes)
             if score > args.threshold
-        ]
+        )
+        last_detections = [det for det in detections if in_roi_band(det)]
         return last_detections
     except Exception as e:
         print(f"Error parsing detections: {e}", file=sys.stderr)
         return last_detections
 
+def in_roi_band(detection, band=None):
+    """True if the detection overlaps band, by default the AOI band (or no band is configured)."""
+    band = band or roi_band
+    if band is None:
+        return True
+    _, y, _, h = detection.box
+    return y < band[1] and y + h > band[0]
+
 def get_labels():
     """Load labels from file, ensuring compatibility with state machine."""
     try:
@@ -65,6 +108,45 @@ def get_labels():
         print(f"Error loading labels: {e}", file=sys.stderr)
         return []
 
+class FrameRateController:
+    """Lower the camera frame rate while the driveway is empty and restore it on the first detection.
+
+    The rate drops to idle_fps after idle_after seconds without an active
+    detection and returns to full_fps on the first frame that has one. A
+    detection counts as active when it overlaps the vertical band (y0, y1),
+    or anywhere when no band is set. Frame numbers stay consecutive at any
+    rate, so the counter's frame-gap handling is unaffected.
+    """
+
+    def __init__(self, picam2, full_fps, idle_fps, idle_after, band=None):
+        self.picam2 = picam2
+        self.full_fps = full_fps
+        self.idle_fps = idle_fps
+        self.idle_after = idle_after
+        self.band = band
+        self.fps = full_fps
+        self.last_active = time.monotonic()
+
+    def is_active(self, detection):
+        return in_roi_band(detection, self.band)
+
+    def update(self, detections):
+        now = time.monotonic()
+        if any(self.is_active(det) for det in detections):
+            self.last_active = now
+            if self.fps != self.full_fps:
+                self.set_fps(self.full_fps)
+        elif self.fps != self.idle_fps and now - self.last_active >= self.idle_after:
+            self.set_fps(self.idle_fps)
+
+    def set_fps(self, fps):
+        try:
+            self.picam2.set_controls({"FrameRate": fps})
+            print(f"Frame rate {self.fps} -> {fps} fps", file=sys.stderr)
+            self.fps = fps
+        except Exception as e:
+            print(f"Error setting frame rate: {e}", file=sys.stderr)
+
 def draw_detections(request, stream="main"):
     """Draw the detections for this request onto the ISP output."""
     detections = last_results
@@ -72,7 +154,7 @@ def draw_detections(request, stream="main"):
         return
     labels = get_labels()
     try:
-        with MappedArray(request, stream) as m:
+        with backend.MappedArray(request, stream) as m:
             for detection in detections:
                 x, y, w, h = detection.box
                 label = f"{labels[int(detection.category)]} ({float(detection.conf):.2f})"
@@ -103,7 +185,7 @@ def draw_detections(request, stream="main"):
 
                 cv2.rectangle(m.array, (x, y), (x + w, y + h), (0, 255, 0, 0), thickness=2)
 
-            if args.preserve_aspect_ratio:
+            if args.preserve_aspect_ratio or roi_band is not None:
                 b_x, b_y, b_w, b_h = imx500.get_roi_scaled(request)
                 cv2.putText(
                     m.array,
@@ -120,24 +202,33 @@ def draw_detections(request, stream="main"):
     except Exception as e:
         print(f"Error drawing detections: {e}", file=sys.stderr)
 
-def send_detections(detections):
-    """Send detection data as JSON to named pipe."""
-    global frame_counter, pipe_fd
+def build_detection_record(detections):
+    """Build the per-frame detection record consumed by the counter."""
     labels = get_labels()
     output = {
         "frame": frame_counter,
+        "timestamp": frame_timestamp if frame_timestamp is not None else time.time(),
         "detections": []
     }
+    for det in detections:
+        x, y, w, h = det.box
+        output["detections"].append({
+            "label": labels[int(det.category)],
+            "bbox": [int(x), int(y), int(w), int(h)]
+        })
+    return output
 
+def send_detections(detections):
+    """Send detection data as JSON to the named pipe, or to the network stream when one is configured."""
+    global pipe_fd
     try:
-        for det in detections:
-            x, y, w, h = det.box
-            output["detections"].append({
-                "label": labels[int(det.category)],
-                "bbox": [int(x), int(y), int(w), int(h)]
-            })
-
-        json_str = json.dumps(output) + "\n"
+        record = build_detection_record(detections)
+        json_str = json.dumps(record) + "\n"
+        if recorder is not None:
+            recorder.write(json_str.encode('utf-8'), record["timestamp"])
+        if stream_writer is not None:
+            stream_writer.write(json_str.encode('utf-8'))
+            return
         if pipe_fd is not None:
             try:
                 os.write(pipe_fd, json_str.encode('utf-8'))
@@ -151,7 +242,245 @@ def send_detections(detections):
     except Exception as e:
         print(f"Error sending detections: {e}", file=sys.stderr)
 
-def get_args():
+@contextmanager
+def timed_phase(name):
+    """Time a startup phase and report it on stderr."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.monotonic() - start
+        print(f"Startup phase {name} took {startup_timings[name]:.2f}s", file=sys.stderr)
+
+def open_pipe_writer(pipe_path, timeout=10):
+    """Wait up to timeout seconds for a reader on the named pipe, then open it for writing."""
+    global pipe_fd
+    with timed_phase("pipe_handshake"):
+        if not os.path.exists(pipe_path):
+            os.mkfifo(pipe_path)
+            print(f"Created named pipe at {pipe_path}", file=sys.stderr)
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            try:
+                pipe_fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+                print(f"Opened named pipe {pipe_path} for writing", file=sys.stderr)
+                break
+            except OSError as e:
+                if e.errno != 6:  # ENXIO (no reader)
+                    print(f"Pipe error: {e}", file=sys.stderr)
+                    pipe_fd = None
+                    break
+                print(f"Waiting for reader on {pipe_path}...", file=sys.stderr)
+                time.sleep(1)
+        else:
+            print(f"No reader after {timeout}s, using stderr", file=sys.stderr)
+            pipe_fd = None
+
+def init_imx500(args):
+    """Create the IMX500 device and resolve its network intrinsics from the model and args."""
+    imx500 = backend.IMX500(args.model)
+    intrinsics = imx500.network_intrinsics
+    if not intrinsics:
+        intrinsics = backend.NetworkIntrinsics()
+        intrinsics.task = "object detection"
+    elif intrinsics.task != "object detection":
+        print("Network is not an object detection task", file=sys.stderr)
+        sys.exit(1)
+
+    # Load labels
+    if args.labels:
+        try:
+            with open(args.labels, "r") as f:
+                intrinsics.labels = f.read().splitlines()
+        except Exception as e:
+            print(f"Error reading labels file: {e}", file=sys.stderr)
+            sys.exit(1)
+    elif intrinsics.labels is None:
+        try:
+            intrinsics.labels = ["car", "Service_car"]
+        except Exception as e:
+            print(f"Error reading default labels: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    # Override intrinsics from args
+    for key, value in vars(args).items():
+        if key != "labels" and hasattr(intrinsics, key) and value is not None:
+            setattr(intrinsics, key, value)
+
+    intrinsics.update_with_defaults()
+    return imx500, intrinsics
+
+def start_camera(imx500, intrinsics, args):
+    """Configure and start the camera with the selected profile, uploading the network firmware to the sensor."""
+    global box_scale
+    profile = CAMERA_PROFILES[args.camera_profile]
+    picam2 = backend.Picamera2(imx500.camera_num)
+    config = picam2.create_preview_configuration(
+        main={"size": profile["main_size"]},
+        controls={"FrameRate": args.fps or intrinsics.inference_rate},
+        buffer_count=profile["buffer_count"],
+        queue=profile["queue"],
+    )
+    main_w, main_h = profile["main_size"]
+    box_scale = (COUNTER_FRAME_SIZE[0] / main_w, COUNTER_FRAME_SIZE[1] / main_h)
+
+    imx500.show_network_fw_progress_bar()
+    picam2.start(config, show_preview=profile["preview"])
+
+    if args.preserve_aspect_ratio:
+        imx500.set_auto_aspect_ratio()
+    return picam2
+
+def program_inference_roi(imx500, picam2, band, frame_size):
+    """Restrict IMX500 inference to a band given in counter coordinates.
+
+    The main stream shows the ScalerCrop rectangle of the sensor scaled to
+    the stream size, so the band is mapped back through both, as
+    imx500.convert_inference_coords does in the other direction. The ROI
+    spans the crop's full width.
+    """
+    crop_x, crop_y, crop_w, crop_h = picam2.camera_controls["ScalerCrop"][2]
+    main_w, main_h = picam2.camera_configuration()["main"]["size"]
+    sensor_rows = []
+    for y in band:
+        main_y = y * main_h / frame_size[1]  # Counter frame -> main stream
+        sensor_rows.append(crop_y + int(main_y * crop_h / main_h))  # Main stream -> sensor pixels in the crop
+    y0 = max(crop_y, sensor_rows[0])
+    y1 = min(crop_y + crop_h, sensor_rows[1])
+    imx500.set_inference_roi_abs((crop_x, y0, crop_w, y1 - y0))
+    print(f"Inference ROI set to sensor rows {y0}-{y1} of crop {crop_y}-{crop_y + crop_h} "
+          f"(band y={band[0]}-{band[1]})", file=sys.stderr)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_benchmark(picam2, seconds, emit):
+    """Run the capture loop for a fixed time and report latency, dropped frames, CPU and memory."""
+    global last_results, frame_counter
+    latencies = []
+    frames = 0
+    dropped = 0
+    last_sensor_ts = None
+    cpu_start = os.times()
+    wall_start = time.monotonic()
+    while time.monotonic() - wall_start < seconds:
+        metadata = picam2.capture_metadata()
+        # SensorTimestamp is CLOCK_MONOTONIC nanoseconds at frame start
+        received = time.monotonic_ns()
+        sensor_ts = metadata.get("SensorTimestamp")
+        frame_duration = metadata.get("FrameDuration")  # microseconds
+        if sensor_ts is not None:
+            latencies.append((received - sensor_ts) / 1e6)
+            if last_sensor_ts is not None and frame_duration:
+                dropped += max(0, round((sensor_ts - last_sensor_ts) / (frame_duration * 1000)) - 1)
+            last_sensor_ts = sensor_ts
+        last_results = parse_detections(metadata)
+        frame_counter += 1
+        emit(last_results)
+        frames += 1
+    wall = time.monotonic() - wall_start
+    cpu_end = os.times()
+    cpu = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    with open("/proc/self/statm") as f:
+        rss_pages = int(f.read().split()[1])
+    return {
+        "profile": args.camera_profile,
+        "seconds": round(wall, 2),
+        "frames": frames,
+        "fps": round(frames / wall, 2),
+        "dropped_frames": dropped,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "max": max(latencies) if latencies else None
+        },
+        "cpu_percent": round(100 * cpu / wall, 1),
+        "rss_mb": round(rss_pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+def run_pipeline(picam2, emit, fps_controller=None):
+    """Run capture, parse and emit as separate stages until stop_event is set.
+
+    Capture runs on the calling thread and hands metadata to a parse thread,
+    which hands detections to an emit thread, through bounded queues that
+    never block the producer: when a stage falls behind, its queue drops
+    frames by its policy (--parse-drop-policy, --emit-drop-policy), so a
+    stalled pipe or stream costs frames rather than camera buffers. Frame
+    numbers and timestamps are assigned at capture, so dropped frames reach
+    the counter as gaps, which it treats as empty frames. Per-stage timing
+    and queue drops are printed every --pipeline-stats-interval seconds and
+    on exit.
+    """
+    global frame_timestamp
+
+    def parse(item):
+        global last_results
+        frame, timestamp, metadata = item
+        last_results = parse_detections(metadata)
+        if fps_controller is not None:
+            fps_controller.update(last_results)
+        emit_queue.put((frame, timestamp, last_results))
+
+    def send(item):
+        global frame_counter, frame_timestamp
+        frame_counter, frame_timestamp, detections = item
+        emit(detections)
+
+    parse_queue = StageQueue("parse", args.parse_queue, args.parse_drop_policy)
+    emit_queue = StageQueue("emit", args.emit_queue, args.emit_drop_policy)
+    stages = [Stage("parse", parse_queue, parse), Stage("emit", emit_queue, send)]
+    capture_timer = StageTimer()
+    for stage in stages:
+        stage.start()
+
+    def stats():
+        return {"capture": capture_timer.stats(), **{stage.name: stage.stats() for stage in stages}}
+
+    frame = frame_counter
+    next_report = time.monotonic() + args.pipeline_stats_interval
+    try:
+        while not stop_event.is_set():
+            try:
+                start = time.perf_counter()
+                metadata = picam2.capture_metadata()
+                capture_timer.add(time.perf_counter() - start)
+                frame += 1
+                parse_queue.put((frame, time.time(), metadata))
+            except Exception as e:
+                print(f"Capture error: {e}", file=sys.stderr)
+            if args.pipeline_stats_interval and time.monotonic() >= next_report:
+                next_report += args.pipeline_stats_interval
+                print(f"Pipeline stats: {json.dumps(stats())}", file=sys.stderr)
+    finally:
+        for stage in stages:
+            stage.stop()
+        frame_timestamp = None
+        print(f"Pipeline stats: {json.dumps(stats())}", file=sys.stderr)
+
+def signal_ready(ready_file=None):
+    """Tell supervisors that frames are flowing (systemd sd_notify and/or a ready file)."""
+    notify_socket = os.environ.get("NOTIFY_SOCKET")
+    if notify_socket:
+        if notify_socket.startswith("@"):
+            notify_socket = "\0" + notify_socket[1:]
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.connect(notify_socket)
+                sock.sendall(b"READY=1")
+        except OSError as e:
+            print(f"sd_notify error: {e}", file=sys.stderr)
+    if ready_file:
+        try:
+            with open(ready_file, "w") as f:
+                json.dump({"pid": os.getpid(), "timings": startup_timings}, f)
+        except OSError as e:
+            print(f"Error writing ready file {ready_file}: {e}", file=sys.stderr)
+
+def get_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--model",
@@ -195,88 +524,240 @@ def get_args():
         default="/tmp/detections.pipe",
         help="Named pipe for JSON output (e.g., /tmp/detections.pipe)"
     )
-    return parser.parse_args()
-
-if __name__ == "__main__":
-    args = get_args()
+    parser.add_argument(
+        "--stream",
+        type=str,
+        metavar="ADDRESS",
+        help="Send detections to a counter on another host at tcp://host:port (or unix:///path) instead of the pipe",
+    )
+    parser.add_argument(
+        "--stream-flush-interval",
+        type=float,
+        default=0.05,
+        help="Seconds between batched sends to --stream",
+    )
+    parser.add_argument(
+        "--stream-buffer",
+        type=int,
+        default=1024,
+        help="Records kept for --stream while the counter is unreachable; older ones are dropped",
+    )
+    parser.add_argument(
+        "--ready-file",
+        type=str,
+        help="File written once frames are flowing, for supervisors (also sends sd_notify READY=1)",
+    )
+    parser.add_argument(
+        "--record-dir",
+        type=str,
+        help="Also append every detection record to DIR/<device>/<day>.jsonl for offline recounts",
+    )
+    parser.add_argument(
+        "--device-name",
+        type=str,
+        default=socket.gethostname(),
+        help="Device name used for recorded detection logs",
+    )
+    parser.add_argument(
+        "--camera-profile",
+        choices=sorted(CAMERA_PROFILES),
+        default="debug",
+        help="Camera pipeline profile: debug (full preview), headless (metadata only) or minimal-latency",
+    )
+    parser.add_argument(
+        "--camera-backend",
+        choices=["picamera2", "simulated"],
+        default="picamera2",
+        help="Real camera, or a simulated IMX500 replaying --sim-tensors (default: synthetic traffic)",
+    )
+    parser.add_argument(
+        "--sim-tensors",
+        type=str,
+        help="Tensors recorded with --record-tensors for the simulated camera to replay",
+    )
+    parser.add_argument("--sim-seed", type=int, default=1, help="Seed for the simulated camera's synthetic traffic")
+    parser.add_argument(
+        "--sim-paced",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Deliver simulated frames at the frame rate instead of as fast as they are read",
+    )
+    parser.add_argument(
+        "--record-tensors",
+        type=str,
+        metavar="PATH",
+        help="Save the network output tensors of the first frames to PATH (.npz) for the simulated camera",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=float,
+        metavar="SECONDS",
+        help="Run the camera for SECONDS without writing detections and print a JSON performance report",
+    )
+    parser.add_argument(
+        "--aoi-config",
+        type=str,
+        default=AOI_CONFIG_PATH,
+        help="AOI layout shared with the counter, used for the inference ROI",
+    )
+    parser.add_argument(
+        "--inference-roi",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Run inference only on the AOI band (mapped through the camera's ScalerCrop) and drop detections "
+             "outside it",
+    )
+    parser.add_argument(
+        "--roi-margin", type=int, default=40, help="Pixels added above and below the AOI band for the inference ROI"
+    )
+    parser.add_argument(
+        "--idle-fps",
+        type=float,
+        help="Frame rate while the driveway is empty (default: always run at full rate)",
+    )
+    parser.add_argument(
+        "--idle-after",
+        type=float,
+        default=30.0,
+        help="Seconds without detections before dropping to --idle-fps",
+    )
+    parser.add_argument(
+        "--activity-band",
+        type=int,
+        nargs=2,
+        metavar=("Y0", "Y1"),
+        help="Only detections overlapping this vertical band keep the full frame rate (default: the AOI band)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Run capture, parse and emit on separate threads so a slow output never stalls the camera. Frames "
+             "dropped from the stage queues reach the counter as frame gaps, which it counts as empty frames, "
+             "so night-pass and probable-pass timing shifts under load",
+    )
+    parser.add_argument(
+        "--parse-queue", type=int, default=2, help="Captured frames that may wait for the parse stage"
+    )
+    parser.add_argument(
+        "--emit-queue", type=int, default=64, help="Parsed frames that may wait for the emit stage"
+    )
+    parser.add_argument(
+        "--parse-drop-policy",
+        choices=DROP_POLICIES,
+        default="drop_oldest",
+        help="Frame to drop when the parse queue is full",
+    )
+    parser.add_argument(
+        "--emit-drop-policy",
+        choices=DROP_POLICIES,
+        default="drop_oldest",
+        help="Frame to drop when the emit queue is full",
+    )
+    parser.add_argument(
+        "--pipeline-stats-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between per-stage timing reports on stderr (0 to report only on exit)",
+    )
+    return parser.parse_args(argv)
+
+def main(argv=None, emit=None):
+    """Run the detector.
+
+    By default detections are written as JSON lines to the named pipe, or
+    streamed to a remote counter with --stream. When emit is given
+    (single-process mode) the pipe is skipped and emit is called with each
+    frame's detections instead.
+    """
+    global args, imx500, intrinsics, picam2, last_results, frame_counter, roi_band, recorder, stream_writer
+    global backend, tensor_recording
+    args = get_args(argv)
+    backend = load_backend(args.camera_backend, args.sim_tensors, args.fps or 30, args.sim_seed, args.sim_paced)
+    if args.record_tensors:
+        tensor_recording = TensorRecording(args.record_tensors)
+    if args.record_dir:
+        recorder = DetectionRecorder(args.record_dir, args.device_name)
+    pipe_mode = emit is None and not args.benchmark and not args.stream
+    if args.benchmark:
+        # Serialize as the pipe would, but do not write anywhere
+        emit = lambda detections: json.dumps(build_detection_record(detections))
+    elif emit is None:
+        emit = send_detections
+        if args.stream:
+            # Connects in the background; frames are buffered until the counter is reachable
+            stream_writer = DetectionStreamWriter(args.stream, args.stream_flush_interval,
+                                                  max_buffered=args.stream_buffer)
+            stream_writer.start()
 
     try:
-        # Initialize named pipe
+        startup_start = time.monotonic()
         pipe_path = args.pipe
-        if not os.path.exists(pipe_path):
-            os.mkfifo(pipe_path)
-            print(f"Created named pipe at {pipe_path}", file=sys.stderr)
-        timeout = 10  # seconds
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            try:
-                pipe_fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
-                print(f"Opened named pipe {pipe_path} for writing", file=sys.stderr)
-                break
-            except OSError as e:
-                if e.errno != 6:  # ENXIO (no reader)
-                    print(f"Pipe error: {e}", file=sys.stderr)
-                    pipe_fd = None
-                    break
-                print(f"Waiting for reader on {pipe_path}...", file=sys.stderr)
-                time.sleep(1)
-        else:
-            print(f"No reader after {timeout}s, using stderr", file=sys.stderr)
-            pipe_fd = None
-
-        # Initialize IMX500
-        imx500 = IMX500(args.model)
-        intrinsics = imx500.network_intrinsics
-        if not intrinsics:
-            intrinsics = NetworkIntrinsics()
-            intrinsics.task = "object detection"
-        elif intrinsics.task != "object detection":
-            print("Network is not an object detection task", file=sys.stderr)
-            sys.exit(1)
-
-        # Load labels
-        if args.labels:
-            try:
-                with open(args.labels, "r") as f:
-                    intrinsics.labels = f.read().splitlines()
-            except Exception as e:
-                print(f"Error reading labels file: {e}", file=sys.stderr)
-                sys.exit(1)
-        elif intrinsics.labels is None:
-            try:
-                intrinsics.labels = ["car", "Service_car"]
-            except Exception as e:
-                print(f"Error reading default labels: {e}", file=sys.stderr)
-                sys.exit(1)
 
-        # Override intrinsics from args
-        for key, value in vars(args).items():
-            if key != "labels" and hasattr(intrinsics, key) and value is not None:
-                setattr(intrinsics, key, value)
+        # Wait for the pipe reader while the firmware and camera come up
+        if pipe_mode:
+            pipe_thread = threading.Thread(target=open_pipe_writer, args=(pipe_path,), name="pipe-handshake", daemon=True)
+            pipe_thread.start()
 
-        intrinsics.update_with_defaults()
+        # Initialize IMX500
+        with timed_phase("imx500_init"):
+            imx500, intrinsics = init_imx500(args)
 
         # Initialize camera
-        picam2 = Picamera2(imx500.camera_num)
-        config = picam2.create_preview_configuration(
-            controls={"FrameRate": args.fps or intrinsics.inference_rate},
-            buffer_count=12,
-        )
+        with timed_phase("camera_start"):
+            picam2 = start_camera(imx500, intrinsics, args)
 
-        imx500.show_network_fw_progress_bar()
-        picam2.start(config, show_preview=True)
-
-        if args.preserve_aspect_ratio:
-            imx500.set_auto_aspect_ratio()
+        if args.inference_roi:
+            try:
+                aoi_layout = load_aoi_config(args.aoi_config)
+                if args.preserve_aspect_ratio:
+                    print("Keeping the aspect-ratio ROI; AOI band only filters detections", file=sys.stderr)
+                else:
+                    program_inference_roi(imx500, picam2, aoi_band(aoi_layout, args.roi_margin), aoi_layout["frame_size"])
+                roi_band = aoi_band(aoi_layout)
+            except Exception as e:
+                print(f"Error setting inference ROI, using the full frame: {e}", file=sys.stderr)
 
         last_results = None
-        picam2.pre_callback = draw_detections
-
-        while True:
+        if CAMERA_PROFILES[args.camera_profile]["draw"]:
+            if cv2 is None:
+                print("OpenCV is not installed; not drawing the overlay", file=sys.stderr)
+            else:
+                picam2.pre_callback = draw_detections
+
+        fps_controller = None
+        if args.idle_fps:
+            fps_controller = FrameRateController(
+                picam2, args.fps or intrinsics.inference_rate, args.idle_fps, args.idle_after,
+                args.activity_band or roi_band
+            )
+
+        if pipe_mode:
+            pipe_thread.join()
+
+        with timed_phase("first_frame"):
+            last_results = parse_detections(picam2.capture_metadata())
+        frame_counter += 1
+        emit(last_results)
+        startup_timings["total"] = time.monotonic() - startup_start
+        print(f"Detector ready in {startup_timings['total']:.2f}s", file=sys.stderr)
+        signal_ready(args.ready_file)
+
+        if args.benchmark:
+            print(json.dumps(run_benchmark(picam2, args.benchmark, emit), indent=2))
+            return
+
+        if args.pipeline:
+            run_pipeline(picam2, emit, fps_controller)
+            return
+
+        while not stop_event.is_set():
             try:
                 last_results = parse_detections(picam2.capture_metadata())
                 frame_counter += 1
-                send_detections(last_results)
+                emit(last_results)
+                if fps_controller is not None:
+                    fps_controller.update(last_results)
             except Exception as e:
                 print(f"Main loop error: {e}", file=sys.stderr)
     except KeyboardInterrupt:
@@ -287,10 +768,23 @@ if __name__ == "__main__":
         try:
             if pipe_fd is not None:
                 os.close(pipe_fd)
-            if os.path.exists(pipe_path):
+            if stream_writer is not None:
+                stream_writer.close()
+                print(f"Detection stream: {json.dumps(stream_writer.stats())}", file=sys.stderr)
+            if pipe_mode and os.path.exists(pipe_path):
                 os.unlink(pipe_path)
                 print(f"Removed named pipe {pipe_path}", file=sys.stderr)
+            if args.ready_file and os.path.exists(args.ready_file):
+                os.unlink(args.ready_file)
+            if recorder is not None:
+                recorder.close()
+            if tensor_recording is not None:
+                tensor_recording.save()
             picam2.stop()
             picam2.close()
         except Exception as e:
-            print(f"Cleanup error: {e}", file=sys.stderr)
\ No newline at end of file
+            print(f"Cleanup error: {e}", file=sys.stderr)
+
+if __name__ == "__main__":
+    sampling_profiler.install("detector")
+    main()
@@ -0,0 +1,216 @@
+"""Load test for the master's /update_passed with simulated gate clients.
+
+Each client is a thread acting as one entry or exit gate device. It posts
+sequenced pass-event batches with a Poisson ("realistic") or synchronized
+("burst") pattern, over a kept-alive connection or a fresh one per request.
+Failed batches are retried, which is safe because the master deduplicates
+events. When the run ends, throughput, latency percentiles, error counts and
+the final occupancy are compared against the expected value.
+
+Point it at a test master: the simulated passes change its occupancy.
+"""
+import argparse
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+class GateClient(threading.Thread):
+    """One simulated gate device posting pass events."""
+
+    def __init__(self, index, role, args, run_id, start_barrier, burst_event, results):
+        super().__init__(name=f"gate-{index}", daemon=True)
+        self.role = role
+        self.args = args
+        self.device_id = f"loadtest-{run_id}-{index}"
+        self.boot_epoch = run_id
+        self.seq = 0
+        self.rnd = random.Random(args.seed + index)
+        self.start_barrier = start_barrier
+        self.burst_event = burst_event
+        self.results = results
+        self.conn = None
+        self.latencies = []
+        self.errors = {}
+        self.requests = 0
+        self.events_acked = 0
+        self.unacked = []
+
+    def make_batch(self, size):
+        batch = []
+        for _ in range(size):
+            self.seq += 1
+            batch.append({"device_id": self.device_id, "boot_epoch": self.boot_epoch, "seq": self.seq,
+                          "role": self.role, "ts": time.time()})
+        return batch
+
+    def post(self, batch):
+        """POST one batch; return True if the master acknowledged it."""
+        url = urlsplit(self.args.url)
+        body = json.dumps({"events": batch})
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.args.timeout)
+            self.conn.request("POST", url.path, body, {"Content-Type": "application/json"})
+            response = self.conn.getresponse()
+            response.read()
+            ok = response.status == 200
+            if not ok:
+                self.errors[f"http_{response.status}"] = self.errors.get(f"http_{response.status}", 0) + 1
+        except (OSError, http.client.HTTPException) as e:
+            ok = False
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        self.latencies.append(time.perf_counter() - start)
+        self.requests += 1
+        if not self.args.keepalive and self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        return ok
+
+    def send(self, batch):
+        for _ in range(self.args.retries + 1):
+            if self.post(batch):
+                self.events_acked += len(batch)
+                return
+        self.unacked.extend(batch)
+
+    def run(self):
+        self.start_barrier.wait()
+        deadline = time.monotonic() + self.args.duration
+        if self.args.pattern == "burst":
+            while time.monotonic() < deadline:
+                if not self.burst_event.wait(timeout=max(0.0, deadline - time.monotonic())):
+                    break
+                self.send(self.make_batch(self.args.burst_size))
+                # Wait for the next burst to start
+                while self.burst_event.is_set() and time.monotonic() < deadline:
+                    time.sleep(0.001)
+        else:
+            next_send = time.monotonic()
+            while True:
+                next_send += self.rnd.expovariate(self.args.rate)
+                if next_send >= deadline:
+                    break
+                time.sleep(max(0.0, next_send - time.monotonic()))
+                self.send(self.make_batch(1))
+        # Resend anything whose outcome is unknown so the expected occupancy is exact
+        pending, self.unacked = self.unacked, []
+        for i in range(0, len(pending), 500):
+            self.send(pending[i:i + 500])
+        if self.conn is not None:
+            self.conn.close()
+        self.results.append(self)
+
+def read_occupancy(url, timeout):
+    """Current cars from the master, via an empty event batch."""
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        conn.request("POST", parts.path, json.dumps({"events": []}), {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        return json.loads(response.read())["current_cars"]
+    finally:
+        conn.close()
+
+def percentile_ms(values, fraction):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 2)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Load test the master with simulated gate clients")
+    parser.add_argument("--url", default="http://127.0.0.1:5000/update_passed", help="Master /update_passed URL")
+    parser.add_argument("--clients", type=int, default=200, help="Simulated gate devices")
+    parser.add_argument("--entry-fraction", type=float, default=0.5, help="Fraction of clients that are entry gates")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to generate traffic")
+    parser.add_argument("--pattern", choices=["realistic", "burst"], default="realistic")
+    parser.add_argument("--rate", type=float, default=1.0, help="Passes per second per client (realistic)")
+    parser.add_argument("--burst-interval", type=float, default=2.0, help="Seconds between bursts (burst)")
+    parser.add_argument("--burst-size", type=int, default=10, help="Events per client per burst (burst)")
+    parser.add_argument("--keepalive", action=argparse.BooleanOptionalAction, default=True,
+                        help="Reuse one connection per client instead of connecting per request")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per failed batch")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Also write the JSON report here")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    run_id = int(time.time())
+    occupancy_start = read_occupancy(args.url, args.timeout)
+
+    start_barrier = threading.Barrier(args.clients + 1)
+    burst_event = threading.Event()
+    results = []
+    entry_clients = round(args.clients * args.entry_fraction)
+    clients = [
+        GateClient(i, "entry" if i < entry_clients else "exit", args, run_id, start_barrier, burst_event, results)
+        for i in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    start_barrier.wait()
+    start = time.monotonic()
+    if args.pattern == "burst":
+        while time.monotonic() - start < args.duration:
+            burst_event.set()
+            time.sleep(0.05)
+            burst_event.clear()
+            time.sleep(max(0.0, args.burst_interval - 0.05))
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - start
+
+    occupancy_end = read_occupancy(args.url, args.timeout)
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    errors = {}
+    for client in clients:
+        for kind, count in client.errors.items():
+            errors[kind] = errors.get(kind, 0) + count
+    requests = sum(client.requests for client in clients)
+    entries = sum(client.events_acked for client in clients if client.role == "entry")
+    exits = sum(client.events_acked for client in clients if client.role == "exit")
+    unacked = sum(len(client.unacked) for client in clients)
+    expected = occupancy_start + entries - exits
+    report = {
+        "clients": args.clients,
+        "pattern": args.pattern,
+        "keepalive": args.keepalive,
+        "seconds": round(elapsed, 2),
+        "requests": requests,
+        "requests_per_second": round(requests / elapsed, 1),
+        "events_acked": entries + exits,
+        "events_per_second": round((entries + exits) / elapsed, 1),
+        "errors": errors,
+        "error_rate": round(sum(errors.values()) / requests, 4) if requests else 0.0,
+        "latency_ms": {
+            "p50": percentile_ms(latencies, 0.50),
+            "p90": percentile_ms(latencies, 0.90),
+            "p99": percentile_ms(latencies, 0.99),
+            "max": percentile_ms(latencies, 1.0)
+        },
+        "occupancy": {
+            "start": occupancy_start,
+            "end": occupancy_end,
+            "expected": expected,
+            "unacked_events": unacked,
+            "correct": occupancy_end == expected and unacked == 0
+        }
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if not report["occupancy"]["correct"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Prometheus metrics for the master, updated as requests are handled.
+
+Handlers bump counters and histograms under a lock of their own, never the
+totals lock, and a scrape only formats the current values, so /metrics is
+O(series) and never waits for /update_passed. With --workers every worker
+keeps its own metrics and publishes them each second to a file in the
+metrics directory; a scrape, answered by any one worker, adds the other
+workers' latest files to its own live values. A restarted worker starts
+from zero, which Prometheus sees as a counter reset.
+
+Per-gate series are labeled with the device id only for the configured
+devices (--metrics-devices); events from any other device share the gate
+"other", so clients that invent ids (master_load_test.py) cannot grow the
+series or the published files without bound. Absolute totals are labeled
+by their role.
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Gate label of events from devices outside the configured set
+OTHER_GATE = "other"
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# name -> (type, help), in exposition order
+METRICS = {
+    "parking_master_gate_updates_total": ("counter", "Updates received per gate: pass events, duplicates included, "
+                                                     "or absolute totals"),
+    "parking_master_passes_total": ("counter", "Cars counted per gate and direction"),
+    "parking_master_duplicate_events_total": ("counter", "Pass events per gate that had already been applied"),
+    "parking_master_gate_last_seen_age_seconds": ("gauge", "Seconds since the last update from each gate"),
+    "parking_master_requests_total": ("counter", "HTTP requests by endpoint and status"),
+    "parking_master_request_duration_seconds": ("histogram", "Handler latency by endpoint"),
+    "parking_master_lock_wait_seconds": ("histogram", "Time spent waiting for the totals lock"),
+    "parking_master_count_file_write_seconds": ("histogram", "Latency of count.txt writes"),
+    "parking_master_occupancy": ("gauge", "Cars currently in the lot"),
+}
+
+class MasterMetrics:
+    """Counters, histograms and gauges keyed by (name, labels), where labels is a tuple of (label, value) pairs."""
+
+    def __init__(self, lot, devices=()):
+        self.lot = lot
+        self.devices = frozenset(devices)  # Device ids that get a gate label of their own
+        self.lock = threading.Lock()
+        self.counters = {}
+        # Histogram: per-bucket counts (the last is +Inf, not cumulative) followed by the sum
+        self.histograms = {}
+        self.last_seen = {}  # gate -> Unix time of its last update
+        self.occupancy = 0
+        self.occupancy_at = 0.0
+
+    def _inc(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, labels, seconds):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def gate(self, device_id):
+        """Gate label for a device: its id if configured, else OTHER_GATE."""
+        return device_id if device_id in self.devices else OTHER_GATE
+
+    def record_events(self, events, accepted):
+        """Count a batch of parsed pass events, of which the event log rows in accepted were applied."""
+        now = time.time()
+        received = {}
+        for device_id, _, _, _, _ in events:
+            gate = self.gate(device_id)
+            received[gate] = received.get(gate, 0) + 1
+        with self.lock:
+            for gate, count in received.items():
+                self._inc("parking_master_gate_updates_total", (("gate", gate),), count)
+                self.last_seen[gate] = now
+            for _, device_id, role, count, _, _, _ in accepted:
+                gate = self.gate(device_id)
+                self._inc("parking_master_passes_total", (("gate", gate), ("direction", role)), count)
+                received[gate] -= count
+            for gate, duplicates in received.items():
+                if duplicates:
+                    self._inc("parking_master_duplicate_events_total", (("gate", gate),), duplicates)
+
+    def record_absolute(self, role, delta):
+        """Count an absolute total from a gate that increased it by delta."""
+        with self.lock:
+            self._inc("parking_master_gate_updates_total", (("gate", role),))
+            self.last_seen[role] = time.time()
+            if delta > 0:
+                self._inc("parking_master_passes_total", (("gate", role), ("direction", role)), delta)
+
+    def record_request(self, endpoint, status, seconds):
+        with self.lock:
+            self._inc("parking_master_requests_total", (("endpoint", endpoint), ("status", str(status))))
+            self._observe("parking_master_request_duration_seconds", (("endpoint", endpoint),), seconds)
+
+    def observe_lock_wait(self, seconds):
+        with self.lock:
+            self._observe("parking_master_lock_wait_seconds", (), seconds)
+
+    def observe_count_write(self, seconds):
+        with self.lock:
+            self._observe("parking_master_count_file_write_seconds", (), seconds)
+
+    def set_occupancy(self, cars):
+        with self.lock:
+            self.occupancy = cars
+            self.occupancy_at = time.time()
+
+    def snapshot(self):
+        """Plain-data copy of every value, as published to the metrics directory."""
+        with self.lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, labels, list(values)] for (name, labels), values in self.histograms.items()],
+                "last_seen": dict(self.last_seen),
+                "occupancy": self.occupancy,
+                "occupancy_at": self.occupancy_at
+            }
+
+    def publish(self, path):
+        """Atomically write the snapshot for the other workers' scrapes."""
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error publishing metrics to {path}: {e}")
+
+    def render(self, others=()):
+        """Prometheus text exposition of these metrics plus the snapshots of other workers."""
+        counters = {}
+        histograms = {}
+        last_seen = {}
+        occupancy_at, occupancy = -1.0, 0
+        for snapshot in (self.snapshot(), *others):
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                histograms[key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+            for gate, seen in snapshot["last_seen"].items():
+                last_seen[gate] = max(seen, last_seen.get(gate, seen))
+            if snapshot["occupancy_at"] > occupancy_at:
+                occupancy_at, occupancy = snapshot["occupancy_at"], snapshot["occupancy"]
+
+        now = time.time()
+        gauges = {("parking_master_occupancy", (("lot", self.lot),)): occupancy}
+        for gate, seen in last_seen.items():
+            gauges[("parking_master_gate_last_seen_age_seconds", (("gate", gate),))] = max(0.0, now - seen)
+
+        series = {}
+        for (name, labels), value in (*counters.items(), *gauges.items(), *histograms.items()):
+            series.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series.get(name, ())):
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {value!r}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-1]!r}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+def load_published(directory, exclude=None):
+    """Snapshots published by the other workers in directory (skipping the file exclude)."""
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, "worker-*.json")):
+        if path == exclude:
+            continue
+        try:
+            with open(path, "r") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Error reading metrics from {path}: {e}")
+    return snapshots
+
+def clear_published(directory):
+    """Remove the files of a previous run's workers."""
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "worker-*.json*")):
+        os.unlink(path)
@@ -0,0 +1,404 @@
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Boot epochs remembered per device for deduplicating late retries
+MAX_EPOCHS_PER_DEVICE = 4
+
+# History rows already replayed by every worker are kept this long before being trimmed
+HISTORY_LOG_RETENTION = 600  # seconds
+
+# The single-process totals journal is snapshotted after this many records or this long,
+# which bounds how much log a restart replays
+SNAPSHOT_RECORDS = 10000
+SNAPSHOT_INTERVAL = 60  # seconds
+
+class PassEventLedger:
+    """Track which (device_id, boot_epoch, seq) pass events have been applied."""
+
+    def __init__(self, max_epochs=MAX_EPOCHS_PER_DEVICE):
+        self.max_epochs = max_epochs
+        # device_id -> {boot_epoch: [highest contiguous seq applied, set of seqs applied above it]}
+        self.devices = {}
+
+    def accept(self, device_id, boot_epoch, seq):
+        """Return True if the event is new and mark it applied, False for a duplicate."""
+        epochs = self.devices.setdefault(device_id, {})
+        tracker = epochs.get(boot_epoch)
+        if tracker is None:
+            if len(epochs) >= self.max_epochs and boot_epoch < min(epochs):
+                return False  # Older than every epoch still tracked
+            tracker = epochs[boot_epoch] = [0, set()]
+            while len(epochs) > self.max_epochs:
+                del epochs[min(epochs)]
+        applied_through, applied_above = tracker
+        if seq <= applied_through or seq in applied_above:
+            return False
+        applied_above.add(seq)
+        while applied_through + 1 in applied_above:
+            applied_through += 1
+            applied_above.remove(applied_through)
+        tracker[0] = applied_through
+        return True
+
+class RecordingLedger(PassEventLedger):
+    """PassEventLedger that also lists the events accepted since the last take()."""
+
+    def __init__(self, max_epochs=MAX_EPOCHS_PER_DEVICE):
+        super().__init__(max_epochs)
+        self.accepted = []
+
+    def accept(self, device_id, boot_epoch, seq):
+        if not super().accept(device_id, boot_epoch, seq):
+            return False
+        self.accepted.append((device_id, boot_epoch, seq))
+        return True
+
+    def take(self):
+        accepted, self.accepted = self.accepted, []
+        return accepted
+
+class TotalsJournal:
+    """Write-ahead log of gate total updates plus a periodic snapshot, for the single-process master.
+
+    Every transaction that changes anything appends one JSON line to
+    path + ".log" with the resulting totals and the events it accepted. A
+    snapshot (path + ".snapshot") holds the totals and the whole ledger as of
+    a log record number; once it is safely replaced the log is truncated.
+    Recovery loads the snapshot and replays the records after it, so restart
+    time depends on the log tail, not on the traffic history. Lines reach the
+    OS on every append (surviving a crash of the master) and are fsynced by
+    sync(), which the history ticker calls every second.
+    """
+
+    def __init__(self, path):
+        self.log_path = path + ".log"
+        self.snapshot_path = path + ".snapshot"
+        self.file = None
+        self.record = 0  # Number of the last record written
+        self.snapshot_record = 0
+        self.snapshot_at = time.monotonic()
+        self.dirty = False
+
+    def recover(self, state):
+        """Load the snapshot and the log tail into state; return the number of log records replayed."""
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            state.entry_total_passed, state.exit_total_passed, state.current_cars = snapshot["totals"]
+            state.ledger.devices = {
+                device_id: {int(epoch): [through, set(above)] for epoch, (through, above) in epochs.items()}
+                for device_id, epochs in snapshot["ledger"].items()
+            }
+            self.record = self.snapshot_record = snapshot["record"]
+        replayed = 0
+        valid_bytes = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # A torn last line from a crash mid-write
+                    if not line.endswith(b"\n"):
+                        break
+                    valid_bytes += len(line)
+                    if entry["record"] <= self.snapshot_record:
+                        continue  # Already in the snapshot (crashed before the log was truncated)
+                    state.entry_total_passed, state.exit_total_passed, state.current_cars = entry["totals"]
+                    for device_id, boot_epoch, seq in entry["events"]:
+                        state.ledger.accept(device_id, boot_epoch, seq)
+                    self.record = entry["record"]
+                    replayed += 1
+        state.ledger.take()
+        self.file = open(self.log_path, "ab")
+        self.file.truncate(valid_bytes)
+        return replayed
+
+    def append(self, totals, events):
+        self.record += 1
+        self.file.write(json.dumps({"record": self.record, "totals": totals, "events": events}).encode() + b"\n")
+        self.file.flush()
+        self.dirty = True
+
+    def snapshot_due(self):
+        return (self.record - self.snapshot_record >= SNAPSHOT_RECORDS
+                or (self.record > self.snapshot_record and time.monotonic() - self.snapshot_at >= SNAPSHOT_INTERVAL))
+
+    def save_snapshot(self, state):
+        """Write the snapshot atomically, then truncate the log it covers."""
+        snapshot = {
+            "record": self.record,
+            "saved_at": time.time(),
+            "totals": [state.entry_total_passed, state.exit_total_passed, state.current_cars],
+            "ledger": {
+                device_id: {str(epoch): [through, sorted(above)] for epoch, (through, above) in epochs.items()}
+                for device_id, epochs in state.ledger.devices.items()
+            }
+        }
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.file.truncate(0)
+        self.snapshot_record = self.record
+        self.snapshot_at = time.monotonic()
+        self.dirty = False
+
+    def sync(self):
+        if self.dirty:
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+class MemoryState:
+    """Gate totals and the dedup ledger in process memory, guarded by a lock.
+
+    This is the single-process path. History updates are applied directly,
+    inside the same lock. With a TotalsJournal every change is logged before
+    the lock is released, and recover() rebuilds the totals at startup.
+    metrics (a MasterMetrics) is told how long each transaction waited for the lock.
+    """
+
+    def __init__(self, lock, history, journal=None, metrics=None):
+        self.lock = lock
+        self.history = history
+        self.journal = journal
+        self.metrics = metrics
+        self.entry_total_passed = 0
+        self.exit_total_passed = 0
+        self.current_cars = 0
+        self.ledger = RecordingLedger()
+
+    @contextmanager
+    def transaction(self):
+        start = time.perf_counter()
+        with self.lock:
+            if self.metrics is not None:
+                self.metrics.observe_lock_wait(time.perf_counter() - start)
+            before = (self.entry_total_passed, self.exit_total_passed, self.current_cars)
+            try:
+                yield self
+            finally:
+                # Log whatever changed, even if the update failed halfway, so the journal matches memory
+                totals = (self.entry_total_passed, self.exit_total_passed, self.current_cars)
+                events = self.ledger.take()
+                if self.journal is not None and (events or totals != before):
+                    self.journal.append(totals, events)
+                    if self.journal.snapshot_due():
+                        self.journal.save_snapshot(self)
+
+    def recover(self):
+        """Rebuild the totals from the journal; return the number of log records replayed."""
+        return self.journal.recover(self) if self.journal is not None else 0
+
+    def reset(self):
+        """Zero the totals and forget applied events."""
+        with self.lock:
+            self.entry_total_passed = self.exit_total_passed = self.current_cars = 0
+            self.ledger = RecordingLedger()
+            if self.journal is not None:
+                self.journal.save_snapshot(self)
+
+    def checkpoint(self):
+        """Make logged updates durable and snapshot if due; caller holds the lock."""
+        if self.journal is not None:
+            self.journal.sync()
+            if self.journal.snapshot_due():
+                self.journal.save_snapshot(self)
+
+    def close(self):
+        if self.journal is not None:
+            with self.lock:
+                self.journal.close()
+
+    def record_pass(self, ts, gate, role, count=1):
+        self.history.record_pass(ts, gate, role, count)
+
+    def observe(self, ts, occupancy):
+        self.history.observe(ts, occupancy)
+
+    def read_current_cars(self):
+        return self.current_cars
+
+    def sync_history(self):
+        """Nothing to replay: history is updated in place."""
+
+    def load_history(self, path):
+        self.history.load(path)
+
+    def save_history(self, path):
+        self.history.save(path)
+
+class SqliteLedger(PassEventLedger):
+    """PassEventLedger that loads and writes back device trackers inside a SQLite transaction."""
+
+    def __init__(self, conn, max_epochs=MAX_EPOCHS_PER_DEVICE):
+        super().__init__(max_epochs)
+        self.conn = conn
+
+    def accept(self, device_id, boot_epoch, seq):
+        if device_id not in self.devices:
+            rows = self.conn.execute(
+                "SELECT boot_epoch, applied_through, applied_above FROM ledger WHERE device_id = ?", (device_id,)
+            ).fetchall()
+            self.devices[device_id] = {epoch: [through, set(json.loads(above))] for epoch, through, above in rows}
+        return super().accept(device_id, boot_epoch, seq)
+
+    def flush(self):
+        for device_id, epochs in self.devices.items():
+            self.conn.execute("DELETE FROM ledger WHERE device_id = ?", (device_id,))
+            self.conn.executemany(
+                "INSERT INTO ledger (device_id, boot_epoch, applied_through, applied_above) VALUES (?, ?, ?, ?)",
+                [(device_id, epoch, through, json.dumps(sorted(above))) for epoch, (through, above) in epochs.items()]
+            )
+
+class SqliteState:
+    """Gate totals and the dedup ledger in a SQLite (WAL) database shared by worker processes.
+
+    transaction() runs BEGIN IMMEDIATE, so updates from every worker are
+    serialized by SQLite's write lock and each one sees the totals left by
+    the last. Passes and occupancy changes go to history_log, which every
+    worker replays into its own OccupancyHistory (sync_history), so /history
+    answers the same in any worker. Connections are per thread. Writers
+    queue on a local lock and then an flock on path + ".lock" before BEGIN,
+    so waiting is done by the kernel instead of SQLite's sleeping busy
+    handler. synchronous=NORMAL: a commit survives a worker crash, and only
+    the last moments before a power cut can be lost. metrics (a
+    MasterMetrics) is told how long each writer waited for both locks.
+    """
+
+    def __init__(self, path, history, busy_timeout=10.0, metrics=None):
+        self.path = path
+        self.history = history
+        self.busy_timeout = busy_timeout
+        self.metrics = metrics
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self.history_through = 0  # Last history_log id replayed into this process's history
+        conn = self._conn()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                         "entry INTEGER NOT NULL, exit INTEGER NOT NULL, current INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO totals VALUES (0, 0, 0, 0)")
+            conn.execute("CREATE TABLE IF NOT EXISTS ledger (device_id TEXT NOT NULL, boot_epoch INTEGER NOT NULL, "
+                         "applied_through INTEGER NOT NULL, applied_above TEXT NOT NULL, "
+                         "PRIMARY KEY (device_id, boot_epoch))")
+            conn.execute("CREATE TABLE IF NOT EXISTS history_log (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "applied_at REAL NOT NULL, ts REAL NOT NULL, gate TEXT, role TEXT, count INTEGER, "
+                         "occupancy INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def write_lock(self):
+        start = time.perf_counter()
+        with self.lock:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            if self.metrics is not None:
+                self.metrics.observe_lock_wait(time.perf_counter() - start)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def transaction(self):
+        # The totals, ledger and history rows set here belong to the thread holding the lock
+        conn = self._conn()
+        with self.write_lock():
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.entry_total_passed, self.exit_total_passed, self.current_cars = conn.execute(
+                    "SELECT entry, exit, current FROM totals WHERE id = 0").fetchone()
+                self.ledger = SqliteLedger(conn)
+                self.history_rows = []
+                yield self
+                self.ledger.flush()
+                conn.execute("UPDATE totals SET entry = ?, exit = ?, current = ? WHERE id = 0",
+                             (self.entry_total_passed, self.exit_total_passed, self.current_cars))
+                conn.executemany("INSERT INTO history_log (applied_at, ts, gate, role, count, occupancy) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", self.history_rows)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def record_pass(self, ts, gate, role, count=1):
+        self.history_rows.append((time.time(), ts, gate, role, count, None))
+
+    def observe(self, ts, occupancy):
+        self.history_rows.append((time.time(), ts, None, None, None, occupancy))
+
+    def close(self):
+        """Close this thread's connection and the lock file (the supervisor does so before forking workers)."""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+        os.close(self.lock_fd)
+
+    def read_current_cars(self):
+        return self._conn().execute("SELECT current FROM totals WHERE id = 0").fetchone()[0]
+
+    def checkpoint(self):
+        """Nothing to do: every commit is already in SQLite's write-ahead log."""
+
+    def reset(self):
+        """Zero the totals and forget applied events."""
+        conn = self._conn()
+        with self.write_lock():
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE totals SET entry = 0, exit = 0, current = 0 WHERE id = 0")
+            conn.execute("DELETE FROM ledger")
+            conn.execute("COMMIT")
+
+    def sync_history(self):
+        """Replay history_log rows written by any worker since the last call; caller holds the history lock."""
+        rows = self._conn().execute(
+            "SELECT id, ts, gate, role, count, occupancy FROM history_log WHERE id > ? ORDER BY id",
+            (self.history_through,)
+        ).fetchall()
+        for row_id, ts, gate, role, count, occupancy in rows:
+            if gate is not None:
+                self.history.record_pass(ts, gate, role, count)
+            else:
+                self.history.observe(ts, occupancy)
+            self.history_through = row_id
+
+    def load_history(self, path):
+        """Load the saved history and continue replaying from where it was saved."""
+        self.history.load(path)
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'history_saved_through'").fetchone()
+        self.history_through = row[0] if row else 0
+
+    def save_history(self, path):
+        """Save the history and trim log rows it already contains; caller holds the history lock."""
+        self.history.save(path)
+        conn = self._conn()
+        with self.write_lock():
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('history_saved_through', ?)", (self.history_through,))
+            conn.execute("DELETE FROM history_log WHERE id <= ? AND applied_at < ?",
+                         (self.history_through, time.time() - HISTORY_LOG_RETENTION))
+            conn.execute("COMMIT")
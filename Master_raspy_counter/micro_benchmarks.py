@@ -0,0 +1,392 @@
+"""Micro-benchmarks for the hot paths, compared against stored baselines.
+
+Runs offline on the detector's simulated camera backend, so no Raspberry Pi
+or picamera2 is needed (the overlay is timed only when OpenCV is installed).
+The frames fed to the counter come from the synthetic traffic generator, or
+from a detection log recorded with the detector's --record-dir (--recording).
+
+    python micro_benchmarks.py                   # run all, compare with the baseline
+    python micro_benchmarks.py --only engine_process_frame rectangles_overlap
+    python micro_benchmarks.py --save-baseline   # after a deliberate change
+    python micro_benchmarks.py --check-allocations   # only the allocation check
+
+Each benchmark reports the median per-operation time over ROUNDS rounds.
+Every round is bracketed by a fixed pure-Python calibration loop, and the
+comparison uses the median of the rounds' ratios to it ("relative"), so a
+machine that is slower as a whole for a while (CPU steal on a VM, thermal
+throttling on a Pi) slows both alike and cancels out. A relative result
+above the baseline by more than the benchmark's tolerance (or --tolerance
+for all) is a regression and makes the run exit with status 1. The
+tolerances sit above the run-to-run spread measured on unchanged code.
+Baselines only compare on the same kind of machine; the file records where
+it was made, and a mismatch is reported.
+
+Every run that includes engine_process_frame also checks the counting
+engine's allocations: it runs the engine past warm-up and traces a steady
+stretch of frames with tracemalloc. The run fails if the frames keep any
+memory, or if their short-lived allocations (loop iterators) ever add up to
+more than ALLOCATION_BUDGET bytes. --check-allocations runs only this
+check, without timing anything; test_counting_allocations.py runs it as a
+test.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import Namespace
+
+import numpy as np
+
+from camera_backend import OUTPUTS_KEY, TENSOR_BOXES, load_backend
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BASE_DIR, "micro_benchmarks_baseline.json")
+
+# Each round is timed for at least this long, and the median of ROUNDS is kept
+MIN_ROUND_TIME = 0.2  # seconds
+ROUNDS = 11
+# The calibration loop is timed for at least this long before and after every round
+CALIBRATION_TIME = 0.02  # seconds
+
+# Slowdown relative to the baseline allowed before a regression, for benchmarks that set none
+DEFAULT_TOLERANCE = 0.35
+
+# Most bytes a steady-state engine frame may have allocated at once; it may keep none
+ALLOCATION_BUDGET = 512
+
+BENCHMARKS = {}
+
+def benchmark(name, ops_per_call=1, tolerance=DEFAULT_TOLERANCE):
+    """Register a setup function returning the callable to time; ops_per_call scales the result."""
+    def register(setup):
+        BENCHMARKS[name] = (setup, ops_per_call, tolerance)
+        return setup
+    return register
+
+def calibration_loop():
+    """Fixed interpreter work that the benchmarks are timed against."""
+    total = 0
+    for i in range(1000):
+        total += i * i % 7
+    return total
+
+def machine():
+    return {"node": platform.node(), "machine": platform.machine(), "python": platform.python_version()}
+
+def synthetic_tensors(rnd, detections=4):
+    """Normalized boxes (y0, x0, y1, x1), scores and classes, with a few above the threshold."""
+    y0 = rnd.uniform(0, 0.7, TENSOR_BOXES)
+    x0 = rnd.uniform(0, 0.7, TENSOR_BOXES)
+    boxes = np.stack([y0, x0, y0 + rnd.uniform(0.05, 0.3, TENSOR_BOXES),
+                      x0 + rnd.uniform(0.1, 0.3, TENSOR_BOXES)], axis=1).astype(np.float32)
+    scores = rnd.uniform(0, 0.3, TENSOR_BOXES).astype(np.float32)
+    scores[:detections] = rnd.uniform(0.6, 0.95, detections)
+    classes = rnd.integers(0, 2, TENSOR_BOXES).astype(np.float32)
+    return boxes, scores, classes
+
+def setup_detector(workdir, *argv):
+    """Bring the detector's camera path up on the unpaced simulated backend, as its main() would."""
+    import imx500_object_detection_car_service_pipe as detector
+    detector.args = detector.get_args(["--camera-backend", "simulated", "--no-sim-paced", *argv])
+    detector.backend = load_backend("simulated", fps=30, paced=False)
+    detector.imx500, detector.intrinsics = detector.init_imx500(detector.args)
+    detector.picam2 = detector.start_camera(detector.imx500, detector.intrinsics, detector.args)
+    detector.roi_band = None
+    detector.recorder = None
+    detector.stream_writer = None
+    detector.tensor_recording = None
+    detector.pipe_fd = os.open(os.devnull, os.O_WRONLY)
+    return detector
+
+def synthetic_records(frames, seed=1):
+    """Detection records from the synthetic traffic generator, busier than the defaults."""
+    from aoi_config import aoi_band, load_aoi_config
+    from synthetic_traffic import TrafficSimulator, get_args
+    layout = load_aoi_config()
+    sim_args = get_args(["--seed", str(seed), "--rate-right", "6", "--rate-left", "2"])
+    sim_args.frame_size = layout["frame_size"]
+    sim = TrafficSimulator(sim_args, aoi_band(layout))
+    return [sim.step() for _ in range(frames)]
+
+def load_detections(options):
+    if options.recording:
+        from detection_log import iter_records
+        return [record.get("detections", []) for record in iter_records(options.recording)]
+    return synthetic_records(options.frames)
+
+@benchmark("parse_detections")
+def bench_parse_detections(options, workdir):
+    detector = setup_detector(workdir)
+    metadata = {OUTPUTS_KEY: synthetic_tensors(np.random.default_rng(1))}
+    if not detector.parse_detections(metadata):
+        raise RuntimeError("parse_detections found nothing in the synthetic tensors")
+    return lambda: detector.parse_detections(metadata)
+
+@benchmark("send_detections")
+def bench_send_detections(options, workdir):
+    detector = setup_detector(workdir)
+    detections = detector.parse_detections({OUTPUTS_KEY: synthetic_tensors(np.random.default_rng(1))})
+    return lambda: detector.send_detections(detections)
+
+@benchmark("detector_frame")
+def bench_detector_frame(options, workdir):
+    """One pass of the detector loop on the simulated camera: capture, parse, overlay (with OpenCV), pipe write."""
+    detector = setup_detector(workdir, "--camera-profile", "debug")
+    if detector.cv2 is not None:
+        detector.picam2.pre_callback = detector.draw_detections
+
+    def frame():
+        detector.last_results = detector.parse_detections(detector.picam2.capture_metadata())
+        detector.frame_counter += 1
+        detector.send_detections(detector.last_results)
+    return frame
+
+@benchmark("pipe_reader_read")
+def bench_pipe_reader_read(options, workdir):
+    """Write one detector record into a FIFO and read it back through PipeReader."""
+    import gui_positions_advanced_master as counter
+    path = os.path.join(workdir, "bench.pipe")
+    os.mkfifo(path)
+    writer = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    reader = counter.PipeReader(path)
+    line = (json.dumps({"frame": 1, "timestamp": time.time(), "detections": [
+        {"label": "car", "bbox": [120, 200, 310, 120]}, {"label": "car", "bbox": [400, 210, 220, 110]}]}) + "\n").encode()
+
+    def read():
+        os.write(writer, line)
+        reader.read()
+    return read
+
+@benchmark("rectangles_overlap", ops_per_call=1000)
+def bench_rectangles_overlap(options, workdir):
+    from counting_engine import rectangles_overlap
+    rnd = np.random.default_rng(1)
+    pairs = [(tuple(int(v) for v in rnd.integers(0, 400, 2)) + tuple(int(v) for v in rnd.integers(50, 300, 2)),
+              tuple(int(v) for v in rnd.integers(0, 400, 2)) + tuple(int(v) for v in rnd.integers(50, 300, 2)))
+             for _ in range(1000)]
+
+    def overlap_all():
+        for box1, box2 in pairs:
+            rectangles_overlap(box1, box2)
+    return overlap_all
+
+class ListReader:
+    """Hands out the recorded frames in a loop with consecutive frame numbers."""
+
+    def __init__(self, detections):
+        self.detections = detections
+        self.frame = 0
+        self.start = time.time()
+
+    def read(self):
+        self.frame += 1
+        return {"frame": self.frame, "timestamp": self.start + self.frame / 30,
+                "detections": self.detections[self.frame % len(self.detections)]}
+
+@benchmark("engine_process_frame")
+def bench_engine_process_frame(options, workdir):
+    """The GUI's process_frame with Tk and the outbox stubbed: read, count, draw callbacks, checkpoint check."""
+    import gui_positions_advanced_master as counter
+    from aoi_config import load_aoi_config
+    from counting_engine import CountingEngine
+    stub = lambda *args, **kwargs: None
+    root = Namespace(after=stub)
+    info_gui = Namespace(root=root, pipe_reader=ListReader(load_detections(options)),
+                         engine=CountingEngine(load_aoi_config()["aois"], on_pass=stub),
+                         update=stub, checkpoint=Namespace(maybe_save=stub))
+    box_gui = Namespace(update=stub)
+    return lambda: counter.process_frame(info_gui, box_gui)
+
+# Includes a count.txt write per request, whose latency varies far more than the CPU's
+@benchmark("master_update_passed", tolerance=2.0)
+def bench_master_update_passed(options, workdir):
+    """POST one pass event to /update_passed through Flask's test client (single-process state)."""
+    import parking_lot_master as master
+    master.BASE_DIR = workdir
+    master.event_log = None
+    client = master.app.test_client()
+    seq = 0
+
+    def post():
+        nonlocal seq
+        seq += 1
+        client.post("/update_passed", json={"events": [{"device_id": "bench", "boot_epoch": 1, "seq": seq,
+                                                         "role": "entry" if seq % 2 else "exit"}]})
+    return post
+
+def check_allocations(options):
+    """Trace the engine on a second pass over the frames, after a first one has warmed it up."""
+    from aoi_config import load_aoi_config
+    from counting_engine import CountingEngine
+    detections = load_detections(options)
+    # Built up front, as the reader would, so only the engine's allocations are traced
+    records = [{"frame": i + 1, "timestamp": 1000.0 + i / 30, "detections": detections[i % len(detections)]}
+               for i in range(2 * len(detections))]
+    warm_up, steady = records[:len(detections)], records[len(detections):]
+    engine = CountingEngine(load_aoi_config()["aois"], verbose=False)
+    process = engine.process
+    for record in warm_up:
+        process(record)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        for record in steady:
+            process(record)
+        end, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        if gc_was_enabled:
+            gc.enable()
+    return {"frames": len(steady), "passes": engine.total_cars_passed, "kept_bytes": end - start,
+            "peak_transient_bytes": peak - start, "budget_bytes": ALLOCATION_BUDGET,
+            "ok": end - start <= 0 and peak - start <= ALLOCATION_BUDGET}
+
+def time_benchmark(fn, ops_per_call, rounds=ROUNDS, min_round_time=MIN_ROUND_TIME):
+    """Median seconds per operation, median ratio to the calibration loop, and operations per round.
+
+    The garbage collector is off while timing, as in timeit, so a collection
+    triggered by earlier benchmarks does not land in one round.
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _time_rounds(fn, ops_per_call, rounds, min_round_time)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def _calls_lasting(fn, min_time):
+    """Number of calls to fn that take at least min_time, and how long they took."""
+    calls = 1
+    while True:
+        elapsed = _time_calls(fn, calls)
+        if elapsed >= min_time:
+            return calls, elapsed
+        calls *= 2 if elapsed < min_time / 10 else max(2, int(min_time / max(elapsed, 1e-9)) + 1)
+
+def _time_calls(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return time.perf_counter() - start
+
+def _time_rounds(fn, ops_per_call, rounds, min_round_time):
+    calls, _ = _calls_lasting(fn, min_round_time)
+    calibration_calls, _ = _calls_lasting(calibration_loop, CALIBRATION_TIME)
+    per_op = []
+    relative = []
+    for _ in range(rounds):
+        before = _time_calls(calibration_loop, calibration_calls)
+        elapsed = _time_calls(fn, calls)
+        after = _time_calls(calibration_loop, calibration_calls)
+        per_op.append(elapsed / (calls * ops_per_call))
+        relative.append(per_op[-1] / ((before + after) / (2 * calibration_calls)))
+    return statistics.median(per_op), statistics.median(relative), calls * ops_per_call
+
+def run(names, options):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            setup, ops_per_call, _ = BENCHMARKS[name]
+            # The code under test logs as it would in production; keep that off the report
+            with open(os.devnull, "w") as sink, contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+                fn = setup(options, workdir)
+                seconds, relative, ops = time_benchmark(fn, ops_per_call)
+            results[name] = {"us_per_op": round(seconds * 1e6, 3), "relative": round(relative, 5), "ops": ops}
+            print(f"{name:24s} {seconds * 1e6:12.3f} us/op {relative:10.4f} x calibration", file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance=None):
+    """Per-benchmark ratio to the baseline and whether it is a regression; tolerance overrides the benchmarks' own."""
+    report = {}
+    for name, result in results.items():
+        allowed = BENCHMARKS[name][2] if tolerance is None else tolerance
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            report[name] = {**result, "baseline_us_per_op": None, "ratio": None, "tolerance": allowed,
+                            "regression": False}
+            continue
+        # Baselines saved before the calibration loop only have the raw time
+        if "relative" in base:
+            ratio = result["relative"] / base["relative"]
+        else:
+            ratio = result["us_per_op"] / base["us_per_op"]
+        report[name] = {**result, "baseline_us_per_op": base["us_per_op"], "ratio": round(ratio, 3),
+                        "tolerance": allowed, "regression": ratio > 1 + allowed}
+    return report
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Run the micro-benchmarks and compare them with the baseline")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float,
+                        help="Allowed slowdown before a regression, for every benchmark (default: each its own)")
+    parser.add_argument("--recording", help="Detection log (.jsonl or .jsonl.gz) for the counter benchmark")
+    parser.add_argument("--frames", type=int, default=3000, help="Synthetic frames for the counter benchmark")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    parser.add_argument("--check-allocations", action="store_true",
+                        help="Only check that steady-state counter frames allocate nothing, without timing")
+    return parser.parse_args()
+
+def main():
+    options = get_args()
+    if options.check_allocations:
+        report = check_allocations(options)
+        print(json.dumps(report, indent=2))
+        if not report["ok"]:
+            print("Counter frames allocate in steady state", file=sys.stderr)
+            sys.exit(1)
+        return
+    names = options.only or list(BENCHMARKS)
+    results = run(names, options)
+    allocations = check_allocations(options) if "engine_process_frame" in names else None
+    if allocations is not None and not allocations["ok"]:
+        print(f"Counter frames allocate in steady state: {allocations}", file=sys.stderr)
+
+    if options.save_baseline:
+        baseline = {"machine": machine(), "saved_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+        if os.path.exists(options.baseline) and options.only:
+            # Keep the benchmarks that were not rerun
+            with open(options.baseline, "r") as f:
+                baseline["results"] = {**json.load(f).get("results", {}), **results}
+        with open(options.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Saved baseline to {options.baseline}", file=sys.stderr)
+        if allocations is not None and not allocations["ok"]:
+            sys.exit(1)
+        return
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline, "r") as f:
+            baseline = json.load(f)
+    else:
+        print(f"No baseline at {options.baseline}; run with --save-baseline", file=sys.stderr)
+    if baseline and baseline.get("machine") != machine():
+        print(f"Baseline was made on {baseline.get('machine')}, not {machine()}; ratios are indicative",
+              file=sys.stderr)
+    report = {"machine": machine(),
+              "benchmarks": compare(results, baseline, options.tolerance), "allocations": allocations}
+    print(json.dumps(report, indent=2))
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    regressions = [name for name, result in report["benchmarks"].items() if result["regression"]]
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+    if regressions or (allocations is not None and not allocations["ok"]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
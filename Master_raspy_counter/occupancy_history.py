@@ -0,0 +1,158 @@
+import math
+import os
+import time
+
+import numpy as np
+
+# One aggregate per period: counts of entries/exits, occupancy extremes, and
+# per-second occupancy samples for a time-weighted average
+BUCKET_DTYPE = np.dtype([
+    ("ts", "i8"),
+    ("entries", "i4"),
+    ("exits", "i4"),
+    ("occ_min", "i4"),
+    ("occ_max", "i4"),
+    ("occ_sum", "i8"),
+    ("samples", "i4"),
+])
+
+# name -> (period in seconds, number of buckets kept)
+LEVELS = {
+    "second": (1, 3600),  # 1 hour
+    "minute": (60, 7 * 24 * 60),  # 1 week
+    "hour": (3600, 366 * 24),  # 1 year
+}
+PERSISTED_LEVELS = ("minute", "hour")
+
+# Most buckets returned for resolution=auto
+MAX_AUTO_POINTS = 1500
+
+def new_ring(size):
+    ring = np.zeros(size, dtype=BUCKET_DTYPE)
+    ring["ts"] = -1
+    return ring
+
+class OccupancyHistory:
+    """Ring buffers of per-second, per-minute and per-hour occupancy aggregates.
+
+    Each series (the lot, or one gate) keeps a fixed ring per level, and every
+    update is applied to all levels at once, so a range query reads
+    precomputed buckets at the requested resolution instead of raw events.
+    Not thread-safe; callers hold the master lock.
+    """
+
+    def __init__(self, lot):
+        self.lot = lot
+        self.series = {}
+
+    def _rings(self, name):
+        rings = self.series.get(name)
+        if rings is None:
+            rings = self.series[name] = {level: new_ring(size) for level, (_, size) in LEVELS.items()}
+        return rings
+
+    def _buckets(self, name, ts):
+        """Yield the bucket for ts at every level that still retains it, resetting stale slots.
+
+        A ts ahead of this machine's clock is taken as now: its bucket would
+        otherwise claim a ring slot early and make the current period's data
+        look older than the retention, dropping it. A non-finite ts has no bucket.
+        """
+        if not math.isfinite(ts):
+            return
+        ts = int(min(ts, time.time()))
+        for level, ring in self._rings(name).items():
+            period, size = LEVELS[level]
+            start = ts - ts % period
+            slot = ring[(start // period) % size]
+            if slot["ts"] != start:
+                if slot["ts"] > start:
+                    continue  # Older than this level's retention
+                slot.fill(0)
+                slot["ts"] = start
+                slot["occ_min"] = np.iinfo(np.int32).max
+                slot["occ_max"] = np.iinfo(np.int32).min
+            yield slot
+
+    def record_pass(self, ts, gate, role, count=1):
+        """Count passes through a gate at time ts in the gate and lot series."""
+        field = "entries" if role == "entry" else "exits"
+        for name in (self.lot, f"gate:{gate}"):
+            for slot in self._buckets(name, ts):
+                slot[field] += count
+
+    def observe(self, ts, occupancy):
+        """Record an occupancy change so short peaks show up in min/max."""
+        for slot in self._buckets(self.lot, ts):
+            slot["occ_min"] = min(slot["occ_min"], occupancy)
+            slot["occ_max"] = max(slot["occ_max"], occupancy)
+
+    def tick(self, ts, occupancy):
+        """Sample the current occupancy; called once per second."""
+        for slot in self._buckets(self.lot, ts):
+            slot["occ_min"] = min(slot["occ_min"], occupancy)
+            slot["occ_max"] = max(slot["occ_max"], occupancy)
+            slot["occ_sum"] += occupancy
+            slot["samples"] += 1
+
+    def query(self, start, end, resolution="auto", series=None):
+        """Return (resolution, buckets) for [start, end) from the precomputed aggregates."""
+        name = series or self.lot
+        if resolution == "auto":
+            resolution = "hour"
+            for level in ("second", "minute"):
+                period, _ = LEVELS[level]
+                if (end - start) / period <= MAX_AUTO_POINTS:
+                    resolution = level
+                    break
+        if resolution not in LEVELS:
+            raise ValueError(f"Unknown resolution {resolution}")
+        rings = self.series.get(name)
+        if rings is None:
+            return resolution, []
+        ring = rings[resolution]
+        period, _ = LEVELS[resolution]
+        selected = ring[(ring["ts"] >= start - start % period) & (ring["ts"] < end)]
+        selected = selected[np.argsort(selected["ts"])]
+        buckets = []
+        for slot in selected:
+            bucket = {
+                "ts": int(slot["ts"]),
+                "entries": int(slot["entries"]),
+                "exits": int(slot["exits"])
+            }
+            if name == self.lot:
+                has_occupancy = slot["occ_min"] <= slot["occ_max"]
+                bucket["min"] = int(slot["occ_min"]) if has_occupancy else None
+                bucket["max"] = int(slot["occ_max"]) if has_occupancy else None
+                bucket["avg"] = round(float(slot["occ_sum"]) / int(slot["samples"]), 2) if slot["samples"] else None
+            buckets.append(bucket)
+        return resolution, buckets
+
+    def save(self, path):
+        """Persist the minute and hour rings (the second ring is not kept across restarts)."""
+        arrays = {
+            f"{name}|{level}": rings[level]
+            for name, rings in self.series.items()
+            for level in PERSISTED_LEVELS
+        }
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error saving occupancy history: {e}")
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path) as data:
+                for key in data.files:
+                    name, level = key.rsplit("|", 1)
+                    if level in PERSISTED_LEVELS and data[key].shape == (LEVELS[level][1],):
+                        self._rings(name)[level] = data[key].astype(BUCKET_DTYPE)
+            print(f"Loaded occupancy history for {len(self.series)} series")
+        except Exception as e:
+            print(f"Error loading occupancy history: {e}")
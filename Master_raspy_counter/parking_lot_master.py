@@ -1,59 +1,401 @@
-from flask import Flask, request, jsonify
+from datetime import datetime
+from flask import Flask, g, request, jsonify
+from werkzeug.serving import make_server
+import argparse
+import math
 import threading
 import os
+import signal
+import socket
+import sys
+import time
+
+from master_metrics import CONTENT_TYPE, MasterMetrics, clear_published, load_published
+from master_state import MemoryState, SqliteState, TotalsJournal
+from occupancy_history import OccupancyHistory
+from pass_event_log import DEFAULT_PAGE_SIZE, PassEventLog
+import sampling_profiler
 
 app = Flask(__name__)
 
-# Global variables for tracking car counts
-entry_total_passed = 0
-exit_total_passed = 0
-current_cars = 0
+# Guards the in-memory totals and the occupancy history
 lock = threading.Lock()
 
 # Directory for count.txt
 BASE_DIR = "/home/abraham/Estacionamiento_B"
 
+# Occupancy history, rolled up per second/minute/hour and saved periodically
+LOT_NAME = os.path.basename(BASE_DIR)
+HISTORY_PATH = os.path.join(BASE_DIR, "occupancy_history.npz")
+HISTORY_SAVE_INTERVAL = 60  # seconds
+history = OccupancyHistory(LOT_NAME)
+
+# Request, lock and occupancy metrics served by /metrics; each worker starts its own
+metrics = MasterMetrics(LOT_NAME)
+METRICS_DIR = os.path.join(BASE_DIR, "metrics")
+metrics_path = None  # This worker's published snapshot, when serving with --workers
+metrics_dir = None
+
+# Gate totals and applied events; each worker replaces this with a SqliteState when serving with --workers
+state = MemoryState(lock, history, metrics=metrics)
+STATE_DB_PATH = os.path.join(BASE_DIR, "master_state.db")
+# Snapshot and write-ahead log of the single-process totals (master_totals.snapshot, master_totals.log)
+STATE_JOURNAL_PATH = os.path.join(BASE_DIR, "master_totals")
+WORKER_RESTART_DELAY = 1  # seconds
+
+# Every counted pass, queryable through /events; each worker opens its own
+EVENT_LOG_PATH = os.path.join(BASE_DIR, "pass_events.db")
+event_log = None
+
 def write_count_to_file(count):
     """Write the current car count to count.txt."""
+    start = time.perf_counter()
     try:
         with open(os.path.join(BASE_DIR, "count.txt"), "w") as f:
             f.write(str(count))
     except Exception as e:
         print(f"Error writing to count.txt: {e}")
+    metrics.observe_count_write(time.perf_counter() - start)
+
+def parse_events(data):
+    """Validate a batch of pass events and return them ordered per device, epoch and sequence."""
+    events = data["events"]
+    if not isinstance(events, list):
+        raise ValueError("events must be a list")
+    now = time.time()
+    parsed = []
+    for event in events:
+        if not isinstance(event, dict):
+            raise ValueError("Each event must be an object")
+        role = event.get("role", data.get("role"))
+        if role not in ("entry", "exit"):
+            raise ValueError("Invalid role")
+        try:
+            device_id, boot_epoch, seq = str(event["device_id"]), int(event["boot_epoch"]), int(event["seq"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each event needs device_id, boot_epoch and seq")
+        try:
+            ts = float(event.get("ts", now))
+        except (TypeError, ValueError):
+            raise ValueError("Event ts must be a Unix time")
+        if not math.isfinite(ts) or ts < 0:
+            raise ValueError("Event ts must be a finite, non-negative Unix time")
+        # A gate clock running ahead must not put passes into the future history
+        parsed.append((device_id, boot_epoch, seq, role, min(ts, now)))
+    parsed.sort()
+    return parsed
+
+def apply_events(totals, events):
+    """Apply new pass events to the gate totals and return the event log rows; call inside state.transaction().
+
+    Each accepted event is counted before its history update, so if that
+    fails the single-process journal still logs the pass along with its
+    ledger mark, and the gate's retry, deduplicated, loses nothing. SqliteState
+    rolls back the whole batch instead.
+    """
+    accepted = []
+    for device_id, boot_epoch, seq, role, ts in events:
+        if not totals.ledger.accept(device_id, boot_epoch, seq):
+            continue
+        if role == "entry":
+            totals.entry_total_passed += 1
+        else:
+            totals.exit_total_passed += 1
+        accepted.append((ts, device_id, role, 1, device_id, boot_epoch, seq))
+        totals.record_pass(ts, device_id, role)
+    return accepted
+
+def log_events(rows):
+    if event_log is not None and not event_log.append(rows):
+        print(f"Pass event log did not commit {len(rows)} events in time")
+
+def update_current_cars(totals):
+    """Recalculate current cars from the gate totals; call inside state.transaction()."""
+    new_current_cars = totals.entry_total_passed - totals.exit_total_passed
+    if new_current_cars != totals.current_cars:
+        totals.current_cars = new_current_cars
+        totals.observe(time.time(), new_current_cars)
+        write_count_to_file(new_current_cars)
+        metrics.set_occupancy(new_current_cars)
+        print(f"Current cars in parking lot: {new_current_cars}")
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    if "request_start" in g:
+        metrics.record_request(request.endpoint or "unmatched", response.status_code,
+                               time.perf_counter() - g.request_start)
+    return response
 
 @app.route('/update_passed', methods=['POST'])
 def update_passed():
-    global entry_total_passed, exit_total_passed, current_cars
+    """Accept either an absolute total for a gate or a batch of pass events.
+
+    Absolute: {"role": "entry"|"exit", "total_cars_passed": N}
+    Events:   {"events": [{"device_id": ..., "boot_epoch": ..., "seq": ..., "role": ..., "ts": ...}, ...]}
+    Events are applied as +1 deltas, once per (device_id, boot_epoch, seq), so
+    retries are safe.
+    """
     try:
         data = request.get_json()
+        if data and "events" in data:
+            try:
+                events = parse_events(data)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            with state.transaction() as totals:
+                accepted = apply_events(totals, events)
+                update_current_cars(totals)
+                cars = totals.current_cars
+            metrics.record_events(events, accepted)
+            log_events(accepted)
+            return jsonify({
+                "status": "success",
+                "accepted": len(accepted),
+                "duplicates": len(events) - len(accepted),
+                "current_cars": cars
+            }), 200
+
         if not data or "role" not in data or "total_cars_passed" not in data:
             return jsonify({"error": "Missing role or total_cars_passed"}), 400
 
         role = data["role"]
         total_cars_passed = data["total_cars_passed"]
 
-        with lock:
+        if role not in ("entry", "exit"):
+            return jsonify({"error": "Invalid role"}), 400
+
+        now = time.time()
+        with state.transaction() as totals:
             if role == "entry":
-                entry_total_passed = total_cars_passed
-            elif role == "exit":
-                exit_total_passed = total_cars_passed
+                delta = total_cars_passed - totals.entry_total_passed
+                totals.entry_total_passed = total_cars_passed
             else:
-                return jsonify({"error": "Invalid role"}), 400
+                delta = total_cars_passed - totals.exit_total_passed
+                totals.exit_total_passed = total_cars_passed
+            if delta > 0:
+                totals.record_pass(now, role, role, delta)
 
             # Calculate current cars
-            new_current_cars = entry_total_passed - exit_total_passed
-            if new_current_cars != current_cars:
-                current_cars = new_current_cars
-                write_count_to_file(current_cars)
-                print(f"Current cars in parking lot: {current_cars}")
+            update_current_cars(totals)
+            cars = totals.current_cars
+        metrics.record_absolute(role, delta)
+        if delta > 0:
+            log_events([(now, role, role, delta, None, None, None)])
 
-        return jsonify({"status": "success", "current_cars": current_cars}), 200
+        return jsonify({"status": "success", "current_cars": cars}), 200
     except Exception as e:
         print(f"Error processing request: {e}")
         return jsonify({"error": str(e)}), 500
 
-if __name__ == "__main__":
-    # Initialize count.txt with 0
-    write_count_to_file(0)
+def parse_time(value):
+    """Parse a query timestamp given as Unix seconds or an ISO 8601 datetime (local time if naive)."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route('/history', methods=['GET'])
+def get_history():
+    """Occupancy history for a time range from the precomputed aggregates.
+
+    Query: start, end (Unix seconds or ISO 8601; default the last hour),
+    resolution (second|minute|hour|auto), gate (a device id or role; default the whole lot).
+    """
+    try:
+        end = parse_time(request.args["end"]) if "end" in request.args else time.time()
+        start = parse_time(request.args["start"]) if "start" in request.args else end - 3600
+        resolution = request.args.get("resolution", "auto")
+        gate = request.args.get("gate")
+        series = f"gate:{gate}" if gate else None
+        with lock:
+            state.sync_history()
+            resolution, buckets = history.query(start, end, resolution, series)
+        return jsonify({
+            "lot": LOT_NAME,
+            "gate": gate,
+            "resolution": resolution,
+            "buckets": buckets
+        }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/events', methods=['GET'])
+def get_events():
+    """Counted passes from the event log, oldest first, one page at a time.
+
+    Query: start, end (Unix seconds or ISO 8601; default the last hour),
+    gate (a device id, or a role for absolute totals), direction (entry|exit),
+    limit (default 100, at most 1000), cursor (next_cursor from the previous page).
+    """
+    if event_log is None:
+        return jsonify({"error": "Pass event log is disabled"}), 404
+    try:
+        end = parse_time(request.args["end"]) if "end" in request.args else time.time()
+        start = parse_time(request.args["start"]) if "start" in request.args else end - 3600
+        direction = request.args.get("direction")
+        if direction not in (None, "entry", "exit"):
+            raise ValueError("direction must be entry or exit")
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+        cursor = None
+        if "cursor" in request.args:
+            cursor_ts, cursor_id = request.args["cursor"].split(":")
+            cursor = (float(cursor_ts), int(cursor_id))
+        events, next_cursor = event_log.query(start, end, request.args.get("gate"), direction, limit, cursor)
+        return jsonify({
+            "lot": LOT_NAME,
+            "events": events,
+            "next_cursor": f"{next_cursor[0]!r}:{next_cursor[1]}" if next_cursor else None
+        }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text format: gate update rates, handler latency, lock wait, count.txt writes, occupancy.
+
+    With --workers the values of every worker are combined.
+    """
+    others = load_published(metrics_dir, metrics_path) if metrics_dir else ()
+    return metrics.render(others), 200, {"Content-Type": CONTENT_TYPE}
+
+def run_history_ticker(save=True):
+    """Sample occupancy into the history every second and save it periodically.
+
+    Also refreshes the occupancy gauge, which other workers may have
+    changed, and publishes this worker's metrics when serving with --workers.
+    """
+    last_saved = time.monotonic()
+    while True:
+        time.sleep(1 - time.time() % 1)
+        current_cars = state.read_current_cars()
+        metrics.set_occupancy(current_cars)
+        if metrics_path is not None:
+            metrics.publish(metrics_path)
+        with lock:
+            state.checkpoint()
+            state.sync_history()
+            history.tick(time.time(), current_cars)
+            if save and time.monotonic() - last_saved >= HISTORY_SAVE_INTERVAL:
+                state.save_history(HISTORY_PATH)
+                last_saved = time.monotonic()
+
+def run_worker(index, sock, args):
+    """Serve requests on the supervisor's listening socket with state shared through SQLite."""
+    global state, event_log, metrics, metrics_dir, metrics_path
+    sampling_profiler.install(f"master-worker-{index}")
+    metrics = MasterMetrics(LOT_NAME, args.metrics_devices)
+    metrics_dir = args.metrics_dir
+    metrics_path = os.path.join(metrics_dir, f"worker-{index}.json")
+    state = SqliteState(args.state_db, history, metrics=metrics)
+    if args.event_log:
+        event_log = PassEventLog(args.event_log)
+    with lock:
+        state.load_history(HISTORY_PATH)
+    # Only the first worker saves the history; the others replay the same log
+    threading.Thread(target=run_history_ticker, args=(index == 0,), name="history-ticker", daemon=True).start()
+    server = make_server(args.host, args.port, app, threaded=True, fd=sock.fileno())
+    print(f"Worker {index} (pid {os.getpid()}) serving", flush=True)
+    server.serve_forever()
+
+def serve_workers(args):
+    """Prefork supervisor: run args.workers processes on one listening socket and restart any that die."""
+    # The totals are durable in the shared database; count.txt is only touched once they are read back
+    start = time.monotonic()
+    shared = SqliteState(args.state_db, history)
+    if args.reset:
+        shared.reset()
+    current_cars = shared.read_current_cars()
+    shared.close()
+    write_count_to_file(current_cars)
+    print(f"Recovered totals in {time.monotonic() - start:.3f}s")
     print(f"Current cars in parking lot: {current_cars}")
-    app.run(host="0.0.0.0", port=5000, debug=False)
\ No newline at end of file
+    clear_published(args.metrics_dir)
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    workers = {}  # pid -> worker index
+
+    def forward_profile_request(signum, frame):
+        # The supervisor only waits; profiling it means profiling the workers
+        sampling_profiler.forward_request(list(workers))
+
+    signal.signal(sampling_profiler.PROFILE_SIGNAL, forward_profile_request)
+
+    def spawn(index):
+        sys.stdout.flush()  # Buffered output would otherwise be printed again by the child
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                run_worker(index, sock, args)
+            except KeyboardInterrupt:
+                status = 0
+            finally:
+                os._exit(status)
+        workers[pid] = index
+
+    try:
+        for index in range(args.workers):
+            spawn(index)
+        while True:
+            pid, status = os.wait()
+            index = workers.pop(pid, None)
+            if index is None:
+                continue
+            print(f"Worker {index} (pid {pid}) exited with status {status}, restarting")
+            time.sleep(WORKER_RESTART_DELAY)
+            spawn(index)
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Parking lot occupancy master")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes; more than one shares state through --state-db")
+    parser.add_argument("--state-db", default=STATE_DB_PATH, help="SQLite database shared by the workers")
+    parser.add_argument("--journal", default=STATE_JOURNAL_PATH,
+                        help="Snapshot and log path prefix for the single-process totals")
+    parser.add_argument("--reset", action="store_true", help="Start from zero instead of the saved totals")
+    parser.add_argument("--event-log", default=EVENT_LOG_PATH,
+                        help="SQLite log of every counted pass served by /events (empty to disable)")
+    parser.add_argument("--metrics-dir", default=METRICS_DIR,
+                        help="Where workers publish their metrics for /metrics to combine")
+    parser.add_argument("--metrics-devices", nargs="*", default=[], metavar="DEVICE_ID",
+                        help="Gate devices with their own /metrics series; events from others count as gate "
+                             "\"other\"")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.workers > 1:
+        serve_workers(args)
+    else:
+        sampling_profiler.install("master")
+        metrics = MasterMetrics(LOT_NAME, args.metrics_devices)
+        # Rebuild the totals before serving or touching count.txt
+        start = time.monotonic()
+        state = MemoryState(lock, history, TotalsJournal(args.journal), metrics)
+        replayed = state.recover()
+        if args.reset:
+            state.reset()
+        write_count_to_file(state.current_cars)
+        print(f"Recovered totals in {time.monotonic() - start:.3f}s ({replayed} log records replayed)")
+        print(f"Current cars in parking lot: {state.current_cars}")
+        metrics.set_occupancy(state.current_cars)
+        state.load_history(HISTORY_PATH)
+        if args.event_log:
+            event_log = PassEventLog(args.event_log)
+        threading.Thread(target=run_history_ticker, name="history-ticker", daemon=True).start()
+        try:
+            app.run(host=args.host, port=args.port, debug=False)
+        finally:
+            state.close()
@@ -0,0 +1,121 @@
+import sqlite3
+import sys
+import threading
+import time
+
+# Longest a handler waits for its events to be committed before answering anyway
+APPEND_WAIT = 1.0  # seconds
+
+# Page size limits for queries
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+EVENT_COLUMNS = ("id", "ts", "gate", "direction", "count", "device_id", "boot_epoch", "seq", "received_at")
+
+class PassEventLog:
+    """Append-only SQLite (WAL) log of every counted pass, indexed by time and by gate.
+
+    append() queues rows for a writer thread and waits until they are
+    committed. The writer commits everything queued since its last commit in
+    one transaction, so concurrent requests share a single commit instead of
+    paying for one each. Several worker processes may append to the same file;
+    SQLite serializes their commits. The totals are committed before their
+    events are logged, so a crash in between loses those events from the log
+    (not from the totals).
+
+    gate is the device id for sequenced events and the role for absolute
+    totals, which are logged as one row with count set to the increase.
+    """
+
+    def __init__(self, path, busy_timeout=10.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.pending = []
+        self.queued = 0  # Rows ever queued
+        self.committed = 0  # Rows ever committed (or given up on)
+        self.closing = False
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS pass_events (id INTEGER PRIMARY KEY, ts REAL NOT NULL, "
+                     "gate TEXT NOT NULL, direction TEXT NOT NULL, count INTEGER NOT NULL, device_id TEXT, "
+                     "boot_epoch INTEGER, seq INTEGER, received_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS pass_events_ts ON pass_events (ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS pass_events_gate_ts ON pass_events (gate, ts)")
+        self.thread = threading.Thread(target=self._run, name="pass-event-log", daemon=True)
+        self.thread.start()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def append(self, rows, timeout=APPEND_WAIT):
+        """Log (ts, gate, direction, count, device_id, boot_epoch, seq) rows; return True once committed."""
+        if not rows:
+            return True
+        received_at = time.time()
+        with self.cond:
+            self.pending.extend(row + (received_at,) for row in rows)
+            self.queued += len(rows)
+            target = self.queued
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: self.committed >= target, timeout)
+
+    def _run(self):
+        conn = self._conn()
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closing)
+                batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT INTO pass_events (ts, gate, direction, count, device_id, boot_epoch, seq, "
+                                 "received_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                print(f"Error writing {len(batch)} pass events to the log: {e}", file=sys.stderr)
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            with self.cond:
+                self.committed += len(batch)
+                self.cond.notify_all()
+
+    def query(self, start, end, gate=None, direction=None, limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """Events with start <= ts < end in (ts, id) order; return (events, cursor for the next page or None).
+
+        The cursor is the (ts, id) of the last event returned, so pages stay
+        consistent while new events are appended.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        where = ["ts >= ?", "ts < ?"]
+        params = [start, end]
+        if gate is not None:
+            where.append("gate = ?")
+            params.append(gate)
+        if direction is not None:
+            where.append("direction = ?")
+            params.append(direction)
+        if cursor is not None:
+            where.append("(ts, id) > (?, ?)")
+            params.extend(cursor)
+        rows = self._conn().execute(
+            f"SELECT {', '.join(EVENT_COLUMNS)} FROM pass_events WHERE {' AND '.join(where)} "
+            f"ORDER BY ts, id LIMIT ?", params + [limit + 1]
+        ).fetchall()
+        events = [dict(zip(EVENT_COLUMNS, row)) for row in rows[:limit]]
+        next_cursor = (events[-1]["ts"], events[-1]["id"]) if len(rows) > limit else None
+        return events, next_cursor
+
+    def close(self, timeout=5.0):
+        """Commit what is queued and stop the writer."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
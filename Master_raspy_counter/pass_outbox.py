@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+import requests
+
+class PassOutbox:
+    """Append-only SQLite (WAL) outbox of pass events waiting to be delivered to the master.
+
+    append() only queues the event in memory; a background thread commits queued
+    events in one transaction per commit interval (group commit) and posts the
+    stored backlog to the master in batches, deleting rows once they are
+    acknowledged. The master deduplicates events, so a batch that was delivered
+    but not acknowledged is simply sent again.
+    """
+
+    def __init__(self, path, url, max_events=100000, batch_size=500,
+                 commit_interval=0.05, retry_interval=2.0, max_retry_interval=60.0):
+        self.path = path
+        self.url = url
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.queued = []  # Appended but not yet committed
+        self.stored = 0  # Committed but not yet acknowledged
+        self.dropped = 0  # Oldest events discarded to keep the outbox bounded
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="pass-outbox", daemon=True)
+        self.thread.start()
+
+    def append(self, event):
+        """Queue a pass event for durable storage and delivery."""
+        with self.lock:
+            self.queued.append(json.dumps(event))
+        self.wakeup.set()
+
+    def backlog(self):
+        """Number of events not yet acknowledged by the master."""
+        with self.lock:
+            return self.stored + len(self.queued)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backlog": self.stored + len(self.queued),
+                "sent": self.sent,
+                "dropped": self.dropped
+            }
+
+    def close(self, timeout=5):
+        """Commit queued events and stop the background thread."""
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, event TEXT NOT NULL)")
+        conn.commit()
+        return conn
+
+    def _commit_queued(self, conn):
+        """Write every queued event in a single transaction, trimming the oldest rows past the bound."""
+        with self.lock:
+            batch, self.queued = self.queued, []
+        if not batch:
+            return
+        with conn:
+            conn.executemany("INSERT INTO outbox (event) VALUES (?)", [(event,) for event in batch])
+            excess = self.stored + len(batch) - self.max_events
+            if excess > 0:
+                conn.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (excess,))
+        with self.lock:
+            self.stored += len(batch)
+            if excess > 0:
+                self.stored -= excess
+                self.dropped += excess
+        if excess > 0:
+            print(f"Outbox full, dropped {excess} oldest pass events", file=sys.stderr)
+
+    def _flush(self, conn):
+        """Post stored events in batches; return False if the master could not be reached."""
+        while True:
+            rows = conn.execute("SELECT id, event FROM outbox ORDER BY id LIMIT ?", (self.batch_size,)).fetchall()
+            if not rows:
+                return True
+            try:
+                response = requests.post(self.url, json={"events": [json.loads(event) for _, event in rows]}, timeout=2)
+            except Exception as e:
+                print(f"Failed to send pass events ({self.backlog()} pending): {e}", file=sys.stderr)
+                return False
+            if response.status_code >= 500:
+                print(f"Error sending pass events to Flask: {response.text}", file=sys.stderr)
+                return False
+            if response.status_code != 200:
+                # The master will never accept this batch; drop it instead of retrying forever
+                print(f"Master rejected {len(rows)} pass events: {response.text}", file=sys.stderr)
+            with conn:
+                conn.execute("DELETE FROM outbox WHERE id <= ?", (rows[-1][0],))
+            with self.lock:
+                self.stored -= len(rows)
+                if response.status_code == 200:
+                    self.sent += len(rows)
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            print(f"Error opening outbox {self.path}: {e}", file=sys.stderr)
+            return
+        with self.lock:
+            self.stored = conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if self.stored:
+            print(f"Outbox {self.path} has {self.stored} undelivered pass events", file=sys.stderr)
+        retry_interval = self.retry_interval
+        next_flush = 0.0
+        try:
+            while True:
+                timeout = max(0.0, next_flush - time.monotonic()) if self.stored else None
+                self.wakeup.wait(timeout)
+                stopping = self.stopping
+                if not stopping:
+                    # Let events appended in the same burst share one commit
+                    time.sleep(self.commit_interval)
+                self.wakeup.clear()
+                self._commit_queued(conn)
+                if stopping:
+                    break
+                if time.monotonic() < next_flush:
+                    continue
+                if self._flush(conn):
+                    retry_interval = self.retry_interval
+                else:
+                    next_flush = time.monotonic() + retry_interval
+                    retry_interval = min(retry_interval * 2, self.max_retry_interval)
+        except sqlite3.Error as e:
+            print(f"Outbox error: {e}", file=sys.stderr)
+        finally:
+            conn.close()
@@ -0,0 +1,159 @@
+"""Recount recorded detection logs with the counting engine, in parallel.
+
+Logs are the files written by the detector's --record-dir option:
+<root>/<device>/<YYYY-MM-DD>.jsonl (optionally gzipped). Every device/day
+file is one shard; shards run in a process pool and their totals and pass
+events are merged into one JSON report. Each shard starts from an empty
+state, so a car crossing the gate exactly at midnight may be missed.
+
+Every gate camera has its own AOI layout, so logs from several devices need
+one --aoi-config device=path per device; a plain path is only accepted when
+all the logs come from one device.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from aoi_config import AOI_CONFIG_PATH, load_aoi_config
+from counting_engine import REFERENCE_FPS, CountingEngine
+from detection_log import iter_records
+
+def find_shards(root, devices=None, first_day=None, last_day=None):
+    """Return (device, day, path) for every log file under root within the filters."""
+    shards = []
+    for path in sorted(glob.glob(os.path.join(root, "*", "*.jsonl*"))):
+        device = os.path.basename(os.path.dirname(path))
+        day = os.path.basename(path).split(".", 1)[0]
+        if devices and device not in devices:
+            continue
+        if (first_day and day < first_day) or (last_day and day > last_day):
+            continue
+        shards.append((device, day, path))
+    return shards
+
+def aoi_config_paths(specs, devices):
+    """Map every device to its AOI layout file from --aoi-config entries (device=path, or one plain path)."""
+    paths = {}
+    default = None
+    for spec in specs:
+        device, sep, path = spec.partition("=")
+        if sep and os.sep not in device:
+            paths[device] = path
+        elif default is None:
+            default = spec
+        else:
+            raise ValueError("Give one plain --aoi-config path at most; use device=path for each device")
+    if default is not None:
+        if paths:
+            raise ValueError("Give either one plain --aoi-config path or device=path entries, not both")
+        if len(devices) > 1:
+            raise ValueError(f"Logs from {len(devices)} devices ({', '.join(sorted(devices))}) need their own "
+                             f"AOI layouts: pass --aoi-config device=path for each")
+        return {device: default for device in devices}
+    missing = sorted(set(devices) - set(paths))
+    if missing:
+        raise ValueError(f"No --aoi-config for {', '.join(missing)}")
+    return {device: paths[device] for device in devices}
+
+def recount_shard(shard, aois, thresholds):
+    """Run one device/day log through a fresh counting engine."""
+    device, day, path = shard
+    passes = []
+
+    def on_pass(engine):
+        passes.append({"frame": engine.current_frame, "timestamp": current_timestamp})
+
+    engine = CountingEngine(aois, on_pass=on_pass, verbose=False, **thresholds)
+    frames = 0
+    current_timestamp = None
+    for record in iter_records(path):
+        current_timestamp = record.get("timestamp")
+        engine.process(record)
+        frames += 1
+    return {
+        "device": device,
+        "day": day,
+        "frames": frames,
+        "total": engine.total_cars_passed,
+        "passes": passes
+    }
+
+def merge_results(results):
+    report = {"devices": {}, "total": 0, "frames": 0}
+    for result in sorted(results, key=lambda r: (r["device"], r["day"])):
+        device = report["devices"].setdefault(result["device"], {"total": 0, "days": {}})
+        device["days"][result["day"]] = {
+            "total": result["total"],
+            "frames": result["frames"],
+            "passes": result["passes"]
+        }
+        device["total"] += result["total"]
+        report["total"] += result["total"]
+        report["frames"] += result["frames"]
+    return report
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Recount recorded detection logs in parallel")
+    parser.add_argument("root", help="Directory written by the detector's --record-dir")
+    parser.add_argument("--devices", nargs="+", help="Only recount these devices")
+    parser.add_argument("--from", dest="first_day", help="First day to recount (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="last_day", help="Last day to recount (YYYY-MM-DD)")
+    parser.add_argument("--aoi-config", nargs="+", default=[AOI_CONFIG_PATH], metavar="[DEVICE=]PATH",
+                        help="AOI layout of each device as device=path, or one path if all logs are from one device")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--overlap-threshold", type=float, default=0.5)
+    # Timing thresholds in seconds
+    parser.add_argument("--absent-time", type=float, default=6 / REFERENCE_FPS)
+    parser.add_argument("--empty-timeout", type=float, default=6 / REFERENCE_FPS)
+    parser.add_argument("--night-pass-empty-time", type=float, default=7 / REFERENCE_FPS)
+    parser.add_argument("--aoi-persist-time", type=float, default=5 / REFERENCE_FPS)
+    parser.add_argument("--confirm-time", type=float, default=5 / REFERENCE_FPS)
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    thresholds = {
+        "overlap_threshold": args.overlap_threshold,
+        "absent_time": args.absent_time,
+        "empty_timeout": args.empty_timeout,
+        "night_pass_empty_time": args.night_pass_empty_time,
+        "aoi_persist_time": args.aoi_persist_time,
+        "confirm_time": args.confirm_time,
+    }
+    shards = find_shards(args.root, args.devices, args.first_day, args.last_day)
+    if not shards:
+        print(f"No detection logs found under {args.root}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        aoi_configs = aoi_config_paths(args.aoi_config, {device for device, _, _ in shards})
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    aois = {device: load_aoi_config(path)["aois"] for device, path in aoi_configs.items()}
+
+    start = time.monotonic()
+    # Largest shards first so one big day does not finish last on its own
+    shards.sort(key=lambda shard: os.path.getsize(shard[2]), reverse=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(recount_shard, shards, [aois[device] for device, _, _ in shards],
+                                [thresholds] * len(shards)))
+    report = merge_results(results)
+    report["thresholds"] = thresholds
+    report["aoi_configs"] = aoi_configs
+    report["shards"] = len(shards)
+    report["seconds"] = round(time.monotonic() - start, 2)
+    print(f"Recounted {len(shards)} shards ({report['frames']} frames) in {report['seconds']}s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+if __name__ == "__main__":
+    main()
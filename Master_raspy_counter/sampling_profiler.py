@@ -0,0 +1,214 @@
+"""On-demand sampling profiler for the long-running processes.
+
+install() only registers a SIGUSR2 handler; nothing runs until a profile is
+requested, so an idle profiler costs nothing. While profiling, a background
+thread samples every thread's Python stack with sys._current_frames() and,
+when the window ends (or on the next signal), writes the counts as collapsed
+stacks (one "thread;outer;...;inner count" line per stack) that
+flamegraph.pl, speedscope or inferno read directly.
+
+Control a running process from the same host:
+
+    python sampling_profiler.py PID                # profile for the default window
+    python sampling_profiler.py PID --seconds 120 --interval 0.005
+    python sampling_profiler.py PID --stop         # stop early and write the file
+
+or send SIGUSR2 yourself to toggle a default-length profile. Requests and
+profiles live in a directory only the process's user can use (see
+private_dir()), so run the command as that user or as root.
+"""
+import argparse
+import json
+import os
+import signal
+import stat
+import sys
+import threading
+import time
+from collections import Counter
+
+# Parent of the per-user directory. Not $XDG_RUNTIME_DIR: services started at boot have none, so
+# the control command in a login session and the process would look in different places
+RUNTIME_ROOT = "/tmp"
+PROFILE_SIGNAL = signal.SIGUSR2
+DEFAULT_INTERVAL = 0.01  # seconds between samples
+DEFAULT_WINDOW = 30.0  # seconds
+MAX_WINDOW = 600.0  # seconds
+
+def private_dir(uid=None):
+    """Directory for a user's request files and profiles, created 0700 and checked before every use.
+
+    The name is predictable, so it is refused unless it is a real directory
+    (not a symlink) owned by the user and closed to everyone else: another
+    local user could otherwise create it first and plant files or links in it.
+    """
+    uid = os.getuid() if uid is None else uid
+    path = os.path.join(RUNTIME_ROOT, f"sampling_profiler-{uid}")
+    try:
+        os.mkdir(path, 0o700)
+        if os.getuid() != uid:
+            os.chown(path, uid, -1)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != uid or info.st_mode & 0o077:
+        raise PermissionError(f"{path} is not a private directory of user {uid}")
+    return path
+
+def request_path(pid, uid=None):
+    """File the control command leaves for the process before signalling it."""
+    return os.path.join(private_dir(uid), f"request-{pid}.json")
+
+def read_request(pid):
+    """Take the request left for pid, or None; a symlink in its place is not followed."""
+    path = request_path(pid)
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return None
+    try:
+        with os.fdopen(fd, "r") as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+def write_request(pid, request, uid=None):
+    """Leave a request for pid, whose files belong to uid (this user by default)."""
+    path = request_path(pid, uid)
+    try:
+        os.unlink(path)  # An earlier request the process never took
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    with os.fdopen(fd, "w") as f:
+        if uid is not None and uid != os.getuid():
+            os.fchown(f.fileno(), uid, -1)
+        f.write(request)
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """Sample all threads' stacks for a bounded window and write a collapsed-stack file."""
+
+    def __init__(self, name, output_dir=None, interval=DEFAULT_INTERVAL, window=DEFAULT_WINDOW):
+        self.name = name
+        self.output_dir = output_dir  # None for private_dir()
+        self.interval = interval
+        self.window = window
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds=None, interval=None):
+        """Start a profile unless one is running; return False if one already was."""
+        if self.active:
+            return False
+        seconds = min(seconds or self.window, MAX_WINDOW)
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, args=(seconds, interval or self.interval),
+                                       name="sampling-profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """End the current profile early; the sampler thread writes the file."""
+        self.stopping.set()
+
+    def _run(self, seconds, interval):
+        print(f"Profiler: sampling {self.name} every {interval * 1000:.0f} ms for up to {seconds:.0f}s",
+              file=sys.stderr)
+        own_ident = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        started_at = time.time()
+        deadline = time.monotonic() + seconds
+        while not self.stopping.wait(interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stacks[tuple(reversed(stack))] += 1
+            samples += 1
+        elapsed = time.time() - started_at
+        try:
+            path = self.write(stacks, started_at)
+            print(f"Profiler: {samples} samples over {elapsed:.1f}s written to {path}", file=sys.stderr)
+        except OSError as e:
+            print(f"Profiler: error writing profile: {e}", file=sys.stderr)
+
+    def write(self, stacks, started_at):
+        output_dir = self.output_dir or private_dir()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(started_at))
+        path = os.path.join(output_dir, f"{self.name}-{os.getpid()}-{stamp}.folded")
+        # Never through an existing file or link
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{';'.join(part.replace(';', ':') for part in stack)} {count}\n")
+        return path
+
+    def handle_signal(self, signum, frame):
+        """Start or stop a profile, as asked by the control command's request file or else by toggling."""
+        request = {}
+        try:
+            request = json.loads(read_request(os.getpid()) or "{}")
+        except (OSError, ValueError) as e:
+            print(f"Profiler: ignoring request: {e}", file=sys.stderr)
+        action = request.get("action", "stop" if self.active else "start")
+        if action == "stop":
+            self.stop()
+        elif not self.start(request.get("seconds"), request.get("interval")):
+            print("Profiler: already running", file=sys.stderr)
+
+def forward_request(pids):
+    """Pass a control request (or a plain toggle) on to other processes, e.g. from a supervisor to its workers."""
+    request = None
+    try:
+        request = read_request(os.getpid())
+    except OSError as e:
+        print(f"Profiler: ignoring request: {e}", file=sys.stderr)
+    for pid in pids:
+        if request is not None:
+            write_request(pid, request)
+        os.kill(pid, PROFILE_SIGNAL)
+
+def install(name, output_dir=None, interval=DEFAULT_INTERVAL, window=DEFAULT_WINDOW):
+    """Let this process be profiled on PROFILE_SIGNAL; call from the main thread."""
+    profiler = SamplingProfiler(name, output_dir, interval, window)
+    signal.signal(PROFILE_SIGNAL, profiler.handle_signal)
+    return profiler
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Start or stop the sampling profiler in a running process")
+    parser.add_argument("pid", type=int, help="Process to profile (the detector, counter or master)")
+    parser.add_argument("--seconds", type=float, default=DEFAULT_WINDOW, help="Profile window")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="Seconds between samples")
+    parser.add_argument("--stop", action="store_true", help="Stop the running profile and write it now")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    request = {"action": "stop"} if args.stop else {"action": "start", "seconds": args.seconds,
+                                                     "interval": args.interval}
+    # The request goes to the directory of the user running the process, which root can write for it
+    try:
+        uid = os.stat(f"/proc/{args.pid}").st_uid
+    except OSError:
+        uid = os.getuid()
+    write_request(args.pid, json.dumps(request), uid)
+    os.kill(args.pid, PROFILE_SIGNAL)
+    if not args.stop:
+        print(f"Profiling {args.pid} for {args.seconds:.0f}s; output goes to {private_dir(uid)}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import json
+import queue
+import sys
+import threading
+
+import imx500_object_detection_car_service_pipe as detector
+import sampling_profiler
+import gui_positions_advanced_master as counter
+
+# Frames buffered between the detection loop and the counter before the oldest is dropped
+QUEUE_SIZE = 64
+
+def make_emitter(record_queue):
+    """Return an emit callback that hands detection records to the counter through the queue.
+
+    When the counter falls behind, the oldest record is dropped; the counter's
+    frame-gap handling treats the missing frames as empty ones.
+    """
+    def emit(detections):
+        record = detector.build_detection_record(detections)
+        if detector.recorder is not None:
+            detector.recorder.write((json.dumps(record) + "\n").encode("utf-8"), record["timestamp"])
+        while True:
+            try:
+                record_queue.put_nowait(record)
+                return
+            except queue.Full:
+                try:
+                    record_queue.get_nowait()
+                except queue.Empty:
+                    pass
+    return emit
+
+def main():
+    """Run the detector and the counter in one process, connected by an in-memory queue.
+
+    Takes the same arguments as the detector script (--pipe is ignored). Run the
+    detector and the GUI as separate processes to debug the FIFO protocol.
+    """
+    sampling_profiler.install("single-process-counter")
+    record_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    detector_thread = threading.Thread(
+        target=detector.main,
+        kwargs={"argv": sys.argv[1:], "emit": make_emitter(record_queue)},
+        name="detector",
+        daemon=True,
+    )
+    detector_thread.start()
+    try:
+        counter.main(counter.QueueReader(record_queue))
+    finally:
+        detector.stop_event.set()
+        detector_thread.join(timeout=5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import collections
+import sys
+import threading
+import time
+
+# Durations kept per stage for the percentile in stats snapshots
+TIMING_WINDOW = 1000
+
+DROP_POLICIES = ("drop_oldest", "drop_newest")
+
+class StageQueue:
+    """Bounded hand-off between two pipeline stages; put() never blocks.
+
+    When the queue is full the policy decides what is lost: drop_oldest
+    discards the oldest queued item, so the consumer catches up on the
+    freshest frames; drop_newest discards the item being put, so what is
+    already queued is delivered in order.
+    """
+
+    def __init__(self, name, maxsize, policy="drop_oldest"):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {policy}")
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item):
+        """Queue item; return False if something was dropped to make room (or item itself was)."""
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == "drop_newest":
+                    return False
+                self.items.popleft()
+                self.items.append(item)
+                self.cond.notify()
+                return False
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Next item, or None if none arrived within timeout."""
+        with self.cond:
+            if not self.items and not self.cond.wait_for(lambda: self.items, timeout):
+                return None
+            return self.items.popleft()
+
+    def stats(self):
+        with self.cond:
+            return {"size": len(self.items), "max_size": self.maxsize, "policy": self.policy,
+                    "dropped": self.dropped, "high_water": self.high_water}
+
+class StageTimer:
+    """Count and duration statistics for one stage."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=TIMING_WINDOW)
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.recent.append(seconds)
+
+    def stats(self):
+        with self.lock:
+            recent = sorted(self.recent)
+            return {
+                "count": self.count,
+                "mean_ms": round(self.total / self.count * 1000, 3) if self.count else None,
+                "p95_ms": round(recent[min(len(recent) - 1, int(0.95 * len(recent)))] * 1000, 3) if recent else None,
+                "max_ms": round(self.max * 1000, 3)
+            }
+
+class Stage(threading.Thread):
+    """Thread applying handler to every item from inbox until stopped."""
+
+    def __init__(self, name, inbox, handler, poll_interval=0.1):
+        super().__init__(name=name, daemon=True)
+        self.inbox = inbox
+        self.handler = handler
+        self.poll_interval = poll_interval
+        self.timer = StageTimer()
+        self.errors = 0
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            item = self.inbox.get(self.poll_interval)
+            if item is None:
+                continue
+            start = time.perf_counter()
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.errors += 1
+                print(f"{self.name} stage error: {e}", file=sys.stderr)
+            self.timer.add(time.perf_counter() - start)
+
+    def stop(self, timeout=2.0):
+        self.stopping.set()
+        self.join(timeout)
+
+    def stats(self):
+        return {**self.timer.stats(), "errors": self.errors, "queue": self.inbox.stats()}
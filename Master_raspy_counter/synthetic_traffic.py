@@ -0,0 +1,272 @@
+"""Synthetic detection stream for stress-testing the counter without a camera.
+
+Emits the same JSON lines as the detector's send_detections ({"frame",
+"timestamp", "detections": [{"label", "bbox"}]}) for simulated cars driving
+through the gate from either side. Cars arrive as Poisson processes per side,
+may stop at the barrier (so followers queue behind them), tailgate, cross
+cars going the other way, be Service_car, get duplicate detections, and drop
+out of single frames or bursts of frames. The cars (arrival times, sizes,
+speeds, barrier waits) are drawn from the seed in seconds before they are
+sampled at the frame rate, so one seed gives the same traffic at every
+--fps; only the per-frame detection noise differs. The ground truth
+(completed passes per direction) is written as JSON when the run ends.
+
+The stream goes to a file, a named pipe (waiting for the counter to open it)
+or stdout, at the configured frame rate or as fast as possible.
+"""
+import argparse
+import json
+import os
+import random
+import stat
+import sys
+import time
+
+from aoi_config import AOI_CONFIG_PATH, aoi_band, load_aoi_config
+
+class SimCar:
+    def __init__(self, car_id, direction, x, y, w, h, speed, label, dwell):
+        self.id = car_id
+        self.direction = direction  # -1 right to left, +1 left to right
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.speed = speed  # Desired speed in px per frame
+        self.label = label
+        self.dwell = dwell  # Frames to wait at the barrier, 0 for none
+        self.stopped_for = 0
+
+    def front(self):
+        return self.x if self.direction < 0 else self.x + self.w
+
+class TrafficSimulator:
+    """Frame-by-frame car simulation along a horizontal driveway."""
+
+    def __init__(self, args, band):
+        self.args = args
+        # Detection noise (dropouts, jitter, duplicates) is drawn per frame
+        self.rnd = random.Random(args.seed)
+        # The cars themselves come from a per-side schedule in seconds, so every frame rate sees the same traffic
+        self.schedule_rnd = {-1: random.Random(f"{args.seed}:right"), 1: random.Random(f"{args.seed}:left")}
+        self.frame_w, self.frame_h = args.frame_size
+        self.band = band
+        self.fps = args.fps
+        self.cars = []
+        self.next_id = 1
+        self.frame = 0
+        # Scheduled arrivals per side waiting for room to enter (queues outside the view)
+        self.waiting = {-1: [], 1: []}
+        self.upcoming = {direction: self.schedule(direction, 0.0) for direction in (-1, 1)}
+        self.last_spawn = {-1: None, 1: None}
+        self.dropout_frames = 0
+        self.passes = []
+        self.spawned = {-1: 0, 1: 0}
+
+    def schedule(self, direction, after):
+        """Draw the next car arriving on this side after the given time, in seconds and px/s."""
+        args = self.args
+        rnd = self.schedule_rnd[direction]
+        rate_per_min = args.rate_right if direction < 0 else args.rate_left
+        if rate_per_min <= 0:
+            return None
+        w = rnd.randint(*args.car_width)
+        h = rnd.randint(*args.car_height)
+        y0, y1 = self.band
+        return {
+            "arrival": after + rnd.expovariate(rate_per_min / 60),
+            "w": w,
+            "h": h,
+            "y": rnd.randint(max(0, y0 - h // 3), max(0, min(self.frame_h - h, y1 - h + h // 3))),
+            "speed": rnd.uniform(*args.speed),
+            "label": "Service_car" if rnd.random() < args.service_ratio else "car",
+            "dwell": rnd.uniform(*args.barrier_dwell) if rnd.random() < args.barrier_stop else 0.0,
+            "tailgate": rnd.random() < args.tailgate
+        }
+
+    def spawn(self, direction, planned, tailgate=False):
+        speed = planned["speed"] / self.fps
+        if tailgate:
+            speed = max(speed, self.last_spawn[direction].speed)
+        w = planned["w"]
+        x = self.frame_w if direction < 0 else -w
+        dwell = int(planned["dwell"] * self.fps)
+        car = SimCar(self.next_id, direction, x, planned["y"], w, planned["h"], speed, planned["label"], dwell)
+        self.next_id += 1
+        self.spawned[direction] += 1
+        self.cars.append(car)
+        self.last_spawn[direction] = car
+
+    def entry_clear(self, direction):
+        """True if the last car from this side has moved far enough in for another to enter."""
+        last = self.last_spawn[direction]
+        if last is None or last not in self.cars:
+            return True
+        gap = (self.frame_w - (last.x + last.w)) if direction < 0 else last.x
+        return gap >= self.args.min_gap
+
+    def move(self):
+        gate_x = self.frame_w / 2
+        for car in sorted(self.cars, key=lambda c: c.front() * c.direction, reverse=True):
+            # Follow the nearest car ahead in the same direction
+            speed = car.speed
+            for other in self.cars:
+                if other is car or other.direction != car.direction:
+                    continue
+                if car.direction < 0 and other.x < car.x:
+                    gap = car.x - (other.x + other.w)
+                elif car.direction > 0 and other.x > car.x:
+                    gap = other.x - (car.x + car.w)
+                else:
+                    continue
+                speed = min(speed, max(0.0, gap - self.args.min_gap))
+            # Wait at the barrier once the car's center reaches the gate
+            center = car.x + car.w / 2
+            if car.dwell and car.stopped_for < car.dwell and abs(center - gate_x) <= max(speed, 1):
+                car.stopped_for += 1
+                speed = 0.0
+            car.x += car.direction * speed
+
+        remaining = []
+        for car in self.cars:
+            if (car.direction < 0 and car.x + car.w < 0) or (car.direction > 0 and car.x > self.frame_w):
+                self.passes.append({"frame": self.frame, "car": car.id, "label": car.label,
+                                    "direction": "right_to_left" if car.direction < 0 else "left_to_right"})
+            else:
+                remaining.append(car)
+        self.cars = remaining
+
+    def detections(self):
+        args = self.args
+        if self.dropout_frames > 0:
+            self.dropout_frames -= 1
+            return []
+        if self.rnd.random() < args.dropout_burst:
+            self.dropout_frames = self.rnd.randint(2, args.max_burst)
+            return []
+        detections = []
+        for car in self.cars:
+            x0 = max(0.0, car.x)
+            x1 = min(float(self.frame_w), car.x + car.w)
+            if x1 - x0 < args.min_visible or self.rnd.random() < args.dropout:
+                continue
+            jitter = [self.rnd.randint(-args.jitter, args.jitter) for _ in range(4)]
+            bbox = [int(x0) + jitter[0], car.y + jitter[1], int(x1 - x0) + jitter[2], car.h + jitter[3]]
+            detections.append({"label": car.label, "bbox": bbox})
+            if self.rnd.random() < args.duplicate:
+                shift = self.rnd.randint(5, 20)
+                detections.append({"label": car.label, "bbox": [bbox[0] + shift, bbox[1], bbox[2] - shift, bbox[3]]})
+        return detections
+
+    def step(self):
+        self.frame += 1
+        now = self.frame / self.fps
+        for direction in (-1, 1):
+            while self.upcoming[direction] and self.upcoming[direction]["arrival"] <= now:
+                planned = self.upcoming[direction]
+                self.upcoming[direction] = self.schedule(direction, planned["arrival"])
+                if planned["tailgate"] and not self.waiting[direction] and self.last_spawn[direction] in self.cars:
+                    self.spawn(direction, planned, tailgate=True)
+                else:
+                    self.waiting[direction].append(planned)
+            if self.waiting[direction] and self.entry_clear(direction):
+                self.spawn(direction, self.waiting[direction].pop(0))
+        self.move()
+        return self.detections()
+
+    def ground_truth(self):
+        right_to_left = sum(1 for p in self.passes if p["direction"] == "right_to_left")
+        left_to_right = len(self.passes) - right_to_left
+        return {
+            "frames": self.frame,
+            "spawned": {"right_to_left": self.spawned[-1], "left_to_right": self.spawned[1]},
+            "passes": {"right_to_left": right_to_left, "left_to_right": left_to_right},
+            "expected_count": right_to_left if self.args.counted_direction == "right_to_left" else left_to_right,
+            "counted_direction": self.args.counted_direction,
+            "in_view_at_end": len(self.cars),
+            "queued_at_end": len(self.waiting[-1]) + len(self.waiting[1]),
+            "pass_events": self.passes
+        }
+
+def open_output(path):
+    if path == "-":
+        return sys.stdout.buffer
+    if os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode):
+        print(f"Waiting for a reader on {path}...", file=sys.stderr)
+    return open(path, "wb")
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic detection stream with ground truth")
+    parser.add_argument("--output", default="/tmp/detections.pipe", help="File, named pipe or - for stdout")
+    parser.add_argument("--truth", help="Write the ground truth JSON here (default: stderr)")
+    parser.add_argument("--duration", type=float, default=600, help="Simulated seconds")
+    parser.add_argument("--fps", type=float, default=30, help="Simulated frame rate")
+    parser.add_argument("--realtime", action="store_true", help="Pace output at --fps instead of as fast as possible")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--aoi-config", default=AOI_CONFIG_PATH, help="AOI layout the cars drive through")
+    parser.add_argument("--rate-right", type=float, default=2.0, help="Cars per minute entering from the right")
+    parser.add_argument("--rate-left", type=float, default=0.5, help="Cars per minute entering from the left")
+    parser.add_argument("--counted-direction", choices=["right_to_left", "left_to_right"], default="right_to_left",
+                        help="Direction the gate counts, for expected_count")
+    parser.add_argument("--speed", type=float, nargs=2, default=(80, 250), metavar=("MIN", "MAX"),
+                        help="Driving speed range in px/s")
+    parser.add_argument("--car-width", type=int, nargs=2, default=(260, 380), metavar=("MIN", "MAX"))
+    parser.add_argument("--car-height", type=int, nargs=2, default=(90, 140), metavar=("MIN", "MAX"))
+    parser.add_argument("--min-gap", type=float, default=30, help="Distance kept to the car ahead in px")
+    parser.add_argument("--barrier-stop", type=float, default=0.5, help="Probability a car stops at the barrier")
+    parser.add_argument("--barrier-dwell", type=float, nargs=2, default=(1.0, 5.0), metavar=("MIN", "MAX"),
+                        help="Barrier wait in seconds")
+    parser.add_argument("--tailgate", type=float, default=0.1, help="Probability an arrival tailgates the previous car")
+    parser.add_argument("--service-ratio", type=float, default=0.1, help="Fraction of Service_car labels")
+    parser.add_argument("--dropout", type=float, default=0.05, help="Probability a single detection is missed")
+    parser.add_argument("--dropout-burst", type=float, default=0.002, help="Probability a burst of empty frames starts")
+    parser.add_argument("--max-burst", type=int, default=6, help="Longest dropout burst in frames")
+    parser.add_argument("--duplicate", type=float, default=0.02, help="Probability of a duplicate overlapping box")
+    parser.add_argument("--jitter", type=int, default=3, help="Bounding box jitter in px")
+    parser.add_argument("--min-visible", type=int, default=20, help="Narrowest visible slice that is detected, in px")
+    return parser.parse_args(argv)
+
+def main():
+    args = get_args()
+    layout = load_aoi_config(args.aoi_config)
+    args.frame_size = layout["frame_size"]
+    sim = TrafficSimulator(args, aoi_band(layout))
+    total_frames = int(args.duration * args.fps)
+    out = open_output(args.output)
+    start_wall = time.time()
+    start = time.monotonic()
+    try:
+        for _ in range(total_frames):
+            detections = sim.step()
+            if args.realtime:
+                delay = start + sim.frame / args.fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                timestamp = time.time()
+            else:
+                timestamp = start_wall + sim.frame / args.fps
+            record = {"frame": sim.frame, "timestamp": timestamp, "detections": detections}
+            out.write((json.dumps(record) + "\n").encode("utf-8"))
+    except BrokenPipeError:
+        print("Reader closed the output", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            out.flush()
+        except BrokenPipeError:
+            pass
+        if out is not sys.stdout.buffer:
+            out.close()
+    elapsed = time.monotonic() - start
+    truth = sim.ground_truth()
+    truth["wall_seconds"] = round(elapsed, 3)
+    truth["frames_per_second"] = round(sim.frame / elapsed, 1) if elapsed > 0 else None
+    if args.truth:
+        with open(args.truth, "w") as f:
+            json.dump(truth, f, indent=2)
+    summary = {key: value for key, value in truth.items() if key != "pass_events"}
+    print(json.dumps(summary), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
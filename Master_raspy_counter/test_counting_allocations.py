@@ -0,0 +1,23 @@
+"""Allocation test for the counting engine's per-frame path.
+
+Runs CountingEngine.process over synthetic traffic under tracemalloc (via
+micro_benchmarks.check_allocations) and fails if steady-state frames keep
+any memory or their transient allocations exceed ALLOCATION_BUDGET.
+
+    python -m pytest test_counting_allocations.py
+    python test_counting_allocations.py
+"""
+import unittest
+from argparse import Namespace
+
+from micro_benchmarks import ALLOCATION_BUDGET, check_allocations
+
+class CountingEngineAllocationTest(unittest.TestCase):
+    def test_steady_frames_keep_no_memory(self):
+        report = check_allocations(Namespace(recording=None, frames=3000))
+        self.assertGreater(report["passes"], 0, "the synthetic traffic should produce passes")
+        self.assertEqual(report["kept_bytes"], 0, report)
+        self.assertLessEqual(report["peak_transient_bytes"], ALLOCATION_BUDGET, report)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,297 @@
+"""Camera backends for the detector: the real Picamera2/IMX500 stack or a simulated IMX500.
+
+A backend provides the four names the detector uses: IMX500(model),
+NetworkIntrinsics(), Picamera2(camera_num) and MappedArray(request, stream).
+The picamera2 backend is the library itself, imported only when selected.
+The simulated backend runs anywhere: its IMX500 emits output tensors
+recorded on a device (--record-tensors) or made from the synthetic traffic
+generator, and its Picamera2 delivers them with frame metadata at the
+configured frame rate, dropping frames as a camera would when the caller
+falls behind. Coordinates go through the same ROI and ISP scaling steps,
+so parsing, conversion, the overlay and the pipe output are all exercised.
+"""
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+# Full sensor size of the IMX500 (PixelArraySize)
+SENSOR_SIZE = (4056, 3040)
+
+# Metadata key the simulated camera uses to hand tensors to the simulated IMX500
+OUTPUTS_KEY = "SimulatedOutputs"
+
+# Candidate boxes per frame in synthetic tensors, like the SSD post-processing output
+TENSOR_BOXES = 100
+TENSOR_INPUT_SIZE = (320, 320)
+
+# Frames kept by --record-tensors (about five minutes at 30 fps)
+MAX_RECORDED_FRAMES = 9000
+
+def picamera2_backend():
+    from picamera2 import MappedArray, Picamera2
+    from picamera2.devices import IMX500
+    from picamera2.devices.imx500 import NetworkIntrinsics
+    return SimpleNamespace(name="picamera2", IMX500=IMX500, NetworkIntrinsics=NetworkIntrinsics,
+                           Picamera2=Picamera2, MappedArray=MappedArray)
+
+def load_backend(name, tensors=None, fps=30, seed=1, paced=True):
+    """Return the named backend; tensors is a recording to replay with the simulated one (default synthetic)."""
+    if name == "picamera2":
+        return picamera2_backend()
+    if name == "simulated":
+        source = RecordedTensors(tensors) if tensors else SyntheticTensors(fps, seed)
+        return SimulatedBackend(source, paced)
+    raise ValueError(f"Unknown camera backend {name}")
+
+class SyntheticTensors:
+    """Output tensors for the cars of the synthetic traffic generator, normalized to the inference ROI."""
+
+    def __init__(self, fps, seed=1, boxes=TENSOR_BOXES, input_size=TENSOR_INPUT_SIZE):
+        from aoi_config import aoi_band, load_aoi_config
+        from synthetic_traffic import TrafficSimulator, get_args
+        layout = load_aoi_config()
+        sim_args = get_args(["--fps", str(fps), "--seed", str(seed)])
+        sim_args.frame_size = layout["frame_size"]
+        self.sim = TrafficSimulator(sim_args, aoi_band(layout))
+        self.frame_size = layout["frame_size"]
+        self.boxes = boxes
+        self.input_size = input_size
+        self.rnd = np.random.default_rng(seed)
+
+    def next(self, roi, sensor_size):
+        detections = self.sim.step()
+        boxes = np.zeros((self.boxes, 4), dtype=np.float32)
+        # Background candidates stay below any sensible detection threshold
+        scores = self.rnd.uniform(0.0, 0.3, self.boxes).astype(np.float32)
+        classes = np.zeros(self.boxes, dtype=np.float32)
+        frame_w, frame_h = self.frame_size
+        sensor_w, sensor_h = sensor_size
+        roi_x, roi_y, roi_w, roi_h = roi
+        i = 0
+        for det in detections[:self.boxes]:
+            x, y, w, h = det["bbox"]
+            # Counter coordinates -> sensor pixels -> normalized to the inference ROI
+            y0 = (y / frame_h * sensor_h - roi_y) / roi_h
+            y1 = ((y + h) / frame_h * sensor_h - roi_y) / roi_h
+            x0 = (x / frame_w * sensor_w - roi_x) / roi_w
+            x1 = ((x + w) / frame_w * sensor_w - roi_x) / roi_w
+            if y1 <= 0 or y0 >= 1 or x1 <= 0 or x0 >= 1:
+                continue  # Outside the ROI, so the network never sees it
+            boxes[i] = np.clip((y0, x0, y1, x1), 0.0, 1.0)
+            scores[i] = self.rnd.uniform(0.6, 0.95)
+            classes[i] = 1 if det["label"] == "Service_car" else 0
+            i += 1
+        return boxes, scores, classes
+
+class RecordedTensors:
+    """Replay tensors saved by TensorRecording, looping at the end."""
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.boxes = data["boxes"]
+            self.scores = data["scores"]
+            self.classes = data["classes"]
+            self.input_size = tuple(int(v) for v in data["input_size"])
+        self.index = 0
+        print(f"Replaying {len(self.boxes)} recorded frames of tensors from {path}", file=sys.stderr)
+
+    def next(self, roi, sensor_size):
+        i = self.index % len(self.boxes)
+        self.index += 1
+        return self.boxes[i], self.scores[i], self.classes[i]
+
+class TensorRecording:
+    """Collect each frame's IMX500 output tensors for replay with the simulated backend.
+
+    Assumes the network's output shapes stay fixed, as with the SSD models.
+    """
+
+    def __init__(self, path, max_frames=MAX_RECORDED_FRAMES):
+        self.path = path
+        self.max_frames = max_frames
+        self.input_size = None
+        self.frames = []
+
+    def add(self, np_outputs, input_size):
+        if len(self.frames) < self.max_frames:
+            self.input_size = input_size
+            self.frames.append(tuple(np.array(output[0]) for output in np_outputs[:3]))
+
+    def save(self):
+        if not self.frames:
+            return
+        boxes, scores, classes = (np.stack(column) for column in zip(*self.frames))
+        np.savez_compressed(self.path, boxes=boxes, scores=scores, classes=classes,
+                            input_size=np.array(self.input_size))
+        print(f"Saved {len(self.frames)} frames of tensors to {self.path}", file=sys.stderr)
+
+class SimulatedNetworkIntrinsics:
+    """Defaults of the SSD MobileNet model the detector ships with."""
+
+    def __init__(self):
+        self.task = "object detection"
+        self.labels = None
+        self.inference_rate = 30
+        self.bbox_normalization = False
+        self.bbox_order = "yx"
+        self.ignore_dash_labels = False
+        self.preserve_aspect_ratio = False
+
+    def update_with_defaults(self):
+        pass
+
+class SimulatedIMX500:
+    """The parts of picamera2's IMX500 the detector uses, fed by a tensor source."""
+
+    def __init__(self, model, source, sensor_size=SENSOR_SIZE):
+        self.model = model
+        self.source = source
+        self.sensor_size = sensor_size
+        self.camera_num = 0
+        self.network_intrinsics = SimulatedNetworkIntrinsics()
+        self.roi = (0, 0) + tuple(sensor_size)
+
+    def show_network_fw_progress_bar(self):
+        print(f"Simulated IMX500: not uploading {self.model}", file=sys.stderr)
+
+    def set_auto_aspect_ratio(self):
+        pass
+
+    def set_inference_roi_abs(self, roi):
+        self.roi = tuple(int(v) for v in roi)
+
+    def get_input_size(self):
+        return self.source.input_size
+
+    def get_outputs(self, metadata, add_batch=False):
+        outputs = metadata.get(OUTPUTS_KEY)
+        if outputs is None:
+            return None
+        return [output[np.newaxis] for output in outputs] if add_batch else list(outputs)
+
+    def convert_inference_coords(self, coords, metadata, picam2):
+        """Normalized (y0, x0, y1, x1) in the inference ROI -> (x, y, w, h) in the main stream."""
+        y0, x0, y1, x1 = np.ravel(coords).astype(float)
+        roi_x, roi_y, roi_w, roi_h = self.roi
+        sensor_w, sensor_h = self.sensor_size
+        main_w, main_h = picam2.main_size
+        x = (roi_x + x0 * roi_w) / sensor_w * main_w
+        y = (roi_y + y0 * roi_h) / sensor_h * main_h
+        w = (x1 - x0) * roi_w / sensor_w * main_w
+        h = (y1 - y0) * roi_h / sensor_h * main_h
+        return tuple(int(v) for v in np.maximum((x, y, w, h), 0))
+
+    def get_roi_scaled(self, request):
+        roi_x, roi_y, roi_w, roi_h = self.roi
+        sensor_w, sensor_h = self.sensor_size
+        main_h, main_w = request.arrays["main"].shape[:2]
+        return (int(roi_x / sensor_w * main_w), int(roi_y / sensor_h * main_h),
+                int(roi_w / sensor_w * main_w), int(roi_h / sensor_h * main_h))
+
+class SimulatedRequest:
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+class SimulatedMappedArray:
+    def __init__(self, request, stream="main"):
+        self.request = request
+        self.stream = stream
+
+    def __enter__(self):
+        self.array = self.request.arrays[self.stream]
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class SimulatedPicamera2:
+    """Frame-paced metadata with the simulated IMX500's tensors, and a blank main stream for the overlay.
+
+    When paced, capture_metadata() waits for the next frame time. If the
+    caller is late, the frames it missed are skipped (their tensors are
+    consumed too, so synthetic traffic keeps real time) and SensorTimestamp
+    jumps ahead, as with a real camera. Unpaced, frames come as fast as
+    they are asked for.
+    """
+
+    def __init__(self, imx500, paced=True):
+        self.imx500 = imx500
+        self.paced = paced
+        self.camera_properties = {"PixelArraySize": imx500.sensor_size}
+        # (min, max, default) like Picamera2; the main stream shows the whole sensor
+        full_sensor = (0, 0) + tuple(imx500.sensor_size)
+        self.camera_controls = {"ScalerCrop": ((0, 0, 64, 64), full_sensor, full_sensor)}
+        self.pre_callback = None
+        self.frame_rate = 30.0
+        self.main_size = (640, 480)
+        self.request = None
+        self.next_frame_ns = None
+
+    def create_preview_configuration(self, main=None, controls=None, buffer_count=4, queue=True):
+        return {"main": dict(main or {}), "controls": dict(controls or {}), "buffer_count": buffer_count,
+                "queue": queue}
+
+    def camera_configuration(self):
+        return {"main": {"size": self.main_size}}
+
+    def start(self, config, show_preview=False):
+        self.main_size = tuple(config["main"].get("size", self.main_size))
+        self.set_controls(config["controls"])
+        main_w, main_h = self.main_size
+        self.request = SimulatedRequest({"main": np.zeros((main_h, main_w, 4), dtype=np.uint8)})
+        self.next_frame_ns = time.monotonic_ns()
+
+    def set_controls(self, controls):
+        if "FrameRate" in controls:
+            self.frame_rate = float(controls["FrameRate"])
+
+    def capture_metadata(self):
+        frame_ns = int(1e9 / self.frame_rate)
+        now = time.monotonic_ns()
+        if not self.paced:
+            sensor_ts = now
+        elif now < self.next_frame_ns:
+            time.sleep((self.next_frame_ns - now) / 1e9)
+            sensor_ts = self.next_frame_ns
+        else:
+            missed = (now - self.next_frame_ns) // frame_ns
+            for _ in range(missed):
+                self.imx500.source.next(self.imx500.roi, self.imx500.sensor_size)
+            sensor_ts = self.next_frame_ns + missed * frame_ns
+        self.next_frame_ns = sensor_ts + frame_ns
+        metadata = {
+            "SensorTimestamp": sensor_ts,
+            "FrameDuration": frame_ns // 1000,
+            OUTPUTS_KEY: self.imx500.source.next(self.imx500.roi, self.imx500.sensor_size)
+        }
+        if self.pre_callback is not None:
+            self.request.arrays["main"].fill(0)
+            self.pre_callback(self.request)
+        return metadata
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+class SimulatedBackend:
+    """Simulated IMX500 and camera sharing one tensor source."""
+
+    name = "simulated"
+    NetworkIntrinsics = SimulatedNetworkIntrinsics
+    MappedArray = SimulatedMappedArray
+
+    def __init__(self, source, paced=True):
+        self.source = source
+        self.paced = paced
+        self.imx500 = None
+
+    def IMX500(self, model):
+        self.imx500 = SimulatedIMX500(model, self.source)
+        return self.imx500
+
+    def Picamera2(self, camera_num=0):
+        return SimulatedPicamera2(self.imx500, self.paced)
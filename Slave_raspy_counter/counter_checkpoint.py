@@ -0,0 +1,171 @@
+import os
+import struct
+import sys
+import time
+import zlib
+
+# Counting states in a fixed order, stored by index
+STATES = ("zero_cars", "one_car", "two_cars", "night_pass", "left_state", "right_state", "probable_pass", "2_cars_left")
+
+MAGIC = b"GCCK"
+VERSION = 3
+
+# magic, version, boot_epoch, saved_at, total_cars_passed, pass_seq, state index,
+# current_frame, last_processed_frame, empty_frame_count, one_car_frame_count,
+# clock, probable_pass_start_time, right_active_since, empty_duration, one_car_duration, aoi_active_times[3]
+HEADER = struct.Struct("<4sHqdQQB4q5d3d")
+# present, id, bbox, last_seen_frame, absent_time
+TRACK = struct.Struct("<?q4fqd")
+# Version 2 stored the id as 8 hex digits (of an MD5 of the first box); same size, so restored as that number
+V2_TRACK = struct.Struct("<?8s4fqd")
+CRC = struct.Struct("<I")
+SIZE = HEADER.size + 2 * TRACK.size + CRC.size
+
+COUNTER_FIELDS = ("current_frame", "last_processed_frame", "empty_frame_count", "one_car_frame_count",
+                  "clock", "probable_pass_start_time", "right_active_since", "empty_duration", "one_car_duration")
+
+class CounterCheckpoint:
+    """Fixed-layout, atomically replaced snapshot of the gate counter state.
+
+    The state is written to a temporary file, fsynced and renamed over the
+    checkpoint, so a power loss leaves either the old or the new snapshot. It
+    is saved at every counted pass and otherwise at most once per interval,
+    never on every frame.
+    """
+
+    def __init__(self, path, boot_epoch, interval=5.0):
+        self.path = path
+        self.boot_epoch = boot_epoch
+        self.interval = interval
+        self.last_saved = 0.0
+
+    def maybe_save(self, counter, pass_seq=0, force=False):
+        """Save if forced (a pass was counted) or the periodic interval has elapsed."""
+        if force or time.monotonic() - self.last_saved >= self.interval:
+            self.save(counter, pass_seq)
+
+    def save(self, counter, pass_seq=0):
+        try:
+            data = HEADER.pack(
+                MAGIC, VERSION, self.boot_epoch, time.time(),
+                counter.total_cars_passed, pass_seq, STATES.index(counter.current_state),
+                *(getattr(counter, field) for field in COUNTER_FIELDS),
+                *counter.aoi_active_times
+            ) + pack_track(counter.car1_data) + pack_track(counter.car2_data)
+            data += CRC.pack(zlib.crc32(data))
+            tmp_path = self.path + ".tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, self.path)
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+            self.last_saved = time.monotonic()
+        except Exception as e:
+            print(f"Error saving checkpoint {self.path}: {e}", file=sys.stderr)
+
+    def restore(self, counter):
+        """Load the last snapshot into counter; return (boot_epoch, pass_seq) or None."""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            print(f"Error reading checkpoint {self.path}: {e}", file=sys.stderr)
+            return None
+        if len(data) != SIZE or CRC.unpack_from(data, SIZE - CRC.size)[0] != zlib.crc32(data[:SIZE - CRC.size]):
+            print(f"Ignoring corrupt checkpoint {self.path}", file=sys.stderr)
+            return None
+        fields = HEADER.unpack_from(data)
+        magic, version, boot_epoch, saved_at, total, pass_seq, state = fields[:7]
+        if magic != MAGIC or version not in (2, VERSION):
+            print(f"Ignoring checkpoint {self.path} with unknown format", file=sys.stderr)
+            return None
+        counter.total_cars_passed = total
+        counter.current_state = STATES[state]
+        for field, value in zip(COUNTER_FIELDS, fields[7:7 + len(COUNTER_FIELDS)]):
+            setattr(counter, field, value)
+        counter.aoi_active_times = list(fields[7 + len(COUNTER_FIELDS):])
+        counter.car1_data = unpack_track(data, HEADER.size, counter.tracks[0], version)
+        counter.car2_data = unpack_track(data, HEADER.size + TRACK.size, counter.tracks[1], version)
+        for track in (counter.car1_data, counter.car2_data):
+            if track:
+                counter.next_track_id = max(counter.next_track_id, track.id + 1)
+        print(f"Restored checkpoint from boot {boot_epoch} saved {time.time() - saved_at:.0f}s ago: "
+              f"{total} cars passed, state {counter.current_state}", file=sys.stderr)
+        return boot_epoch, pass_seq
+
+def next_boot_epoch(path, floor=0):
+    """Boot epoch for this start, above every epoch stored in path and above floor; stored before it is returned.
+
+    The master drops pass events whose (boot_epoch, seq) it has seen, and
+    events from an epoch older than the ones it tracks, so every start needs
+    a larger epoch. It is the Unix time in seconds, like the epochs issued
+    before the file existed, but at least one more than the last one, so a
+    restart within the same second or on a clock that was set back (a Pi
+    without NTP sync) still moves forward. floor is the epoch of a restored
+    checkpoint, which covers a missing or unreadable file.
+    """
+    last = floor
+    try:
+        with open(path, "r") as f:
+            last = max(last, int(f.read().strip()))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable boot epoch file {path}: {e}", file=sys.stderr)
+    epoch = max(int(time.time()), last + 1)
+    try:
+        tmp_path = path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, f"{epoch}\n".encode("ascii"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError as e:
+        print(f"Error saving boot epoch {path}: {e}", file=sys.stderr)
+    return epoch
+
+def pack_track(track):
+    if not track:
+        return TRACK.pack(False, 0, 0, 0, 0, 0, 0, 0)
+    return TRACK.pack(True, track.id, *track.bbox, track.last_seen_frame, track.absent_time)
+
+def unpack_track(data, offset, track, version=VERSION):
+    """Load a stored track into the engine's Track object; return it, or None if the slot was empty."""
+    layout = V2_TRACK if version == 2 else TRACK
+    present, car_id, x, y, w, h, last_seen_frame, absent_time = layout.unpack_from(data, offset)
+    if not present:
+        return None
+    track.id = int(car_id, 16) if version == 2 else car_id
+    track.bbox[:] = [round(x, 1), round(y, 1), round(w, 1), round(h, 1)]
+    track.last_seen_frame = last_seen_frame
+    track.absent_time = absent_time
+    track.in_aoi[:] = [False] * len(track.in_aoi)
+    return track
+
+def rebase_frames(counter, offset):
+    """Shift stored frame numbers by offset after the detector's frame counter restarted.
+
+    Timing state is on the engine clock, which keeps running, so only frame numbers move.
+    """
+    for field in ("current_frame", "last_processed_frame"):
+        if getattr(counter, field) > 0:
+            setattr(counter, field, getattr(counter, field) + offset)
+    for track in (counter.car1_data, counter.car2_data):
+        if track:
+            track.last_seen_frame += offset
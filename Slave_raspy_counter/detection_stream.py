@@ -0,0 +1,251 @@
+import collections
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+READ_SIZE = 65536
+
+def parse_address(address):
+    """Split tcp://host:port or unix:///path into (socket family, socket address)."""
+    if address.startswith("tcp://"):
+        host, port = address[len("tcp://"):].rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://"):]
+    raise ValueError(f"{address} is not a tcp:// or unix:// address")
+
+def is_stream_address(address):
+    return address.startswith(("tcp://", "unix://"))
+
+def listen_socket(address, backlog=1):
+    """Open a non-blocking listening socket on a tcp:// or unix:// address."""
+    family, sockaddr = parse_address(address)
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+    else:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(sockaddr)
+    listener.listen(backlog)
+    listener.setblocking(False)
+    return listener
+
+def remove_socket_file(address):
+    if address.startswith("unix://"):
+        path = address[len("unix://"):]
+        if os.path.exists(path):
+            os.unlink(path)
+
+class DetectionStreamWriter:
+    """Send detection records to a counter over TCP or a Unix socket.
+
+    write() only appends to a bounded in-memory buffer, so the capture loop
+    never waits on the network. A background thread sends whatever is
+    buffered once per flush_interval (sooner once batch_bytes are waiting)
+    and reconnects with backoff when the counter goes away. While it is
+    unreachable the oldest records are dropped beyond max_buffered, which the
+    counter sees as a frame gap. A batch whose send fails is dropped too:
+    part of it may already have arrived, and resending would repeat frames.
+    """
+
+    def __init__(self, address, flush_interval=0.05, batch_bytes=65536, max_buffered=1024,
+                 retry_interval=1.0, max_retry_interval=30.0, send_timeout=5.0):
+        self.address = address
+        self.family, self.sockaddr = parse_address(address)
+        self.flush_interval = flush_interval
+        self.batch_bytes = batch_bytes
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.send_timeout = send_timeout
+        self.buffer = collections.deque(maxlen=max_buffered)
+        self.buffered_bytes = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.sock = None
+        self.next_connect = 0.0
+        self.backoff = retry_interval
+        self.thread = threading.Thread(target=self._run, name="detection-stream", daemon=True)
+        self.records_sent = 0
+        self.records_dropped = 0
+        self.bytes_sent = 0
+        self.connects = 0
+
+    def start(self):
+        self.thread.start()
+
+    def write(self, line):
+        """Queue one serialized record (bytes ending in a newline)."""
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.buffered_bytes -= len(self.buffer[0])
+                self.records_dropped += 1
+            self.buffer.append(line)
+            self.buffered_bytes += len(line)
+            full = self.buffered_bytes >= self.batch_bytes
+        if full:
+            self.wakeup.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "address": self.address,
+                "connected": self.sock is not None,
+                "connects": self.connects,
+                "buffered": len(self.buffer),
+                "records_sent": self.records_sent,
+                "records_dropped": self.records_dropped,
+                "bytes_sent": self.bytes_sent
+            }
+
+    def close(self, timeout=2.0):
+        """Send what is still buffered (if connected) and stop the sender thread."""
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        self._disconnect()
+
+    def _connect(self):
+        if time.monotonic() < self.next_connect:
+            return False
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.send_timeout)
+        try:
+            sock.connect(self.sockaddr)
+        except OSError as e:
+            sock.close()
+            print(f"Detection stream: cannot connect to {self.address} ({e}), retrying in {self.backoff:.0f}s",
+                  file=sys.stderr)
+            self.next_connect = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_retry_interval)
+            return False
+        if self.family == socket.AF_INET:
+            # Records are already batched here
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock = sock
+        self.connects += 1
+        self.backoff = self.retry_interval
+        print(f"Detection stream: connected to {self.address}", file=sys.stderr)
+        return True
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _flush(self):
+        with self.lock:
+            if not self.buffer:
+                return
+            lines = list(self.buffer)
+            self.buffer.clear()
+            self.buffered_bytes = 0
+        batch = b"".join(lines)
+        try:
+            self.sock.sendall(batch)
+        except OSError as e:
+            print(f"Detection stream: send to {self.address} failed ({e}), reconnecting", file=sys.stderr)
+            self._disconnect()
+            with self.lock:
+                self.records_dropped += len(lines)
+            return
+        with self.lock:
+            self.records_sent += len(lines)
+            self.bytes_sent += len(batch)
+
+    def _run(self):
+        while True:
+            stopping = self.stopping.is_set()
+            if self.sock is not None or self._connect():
+                self._flush()
+            if stopping:
+                return
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+
+class DetectionStreamReader:
+    """Accept a detector's stream on tcp://host:port or unix:///path for the GUI counter.
+
+    Same interface as PipeReader: read() returns the next record, or {} when
+    none is waiting, and never blocks. Records arrive in batches and are
+    handed out one per call. A newer detector connection replaces the
+    current one, as after a detector restart.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.listener = None
+        self.conn = None
+        self.buffer = b""
+        self.records = collections.deque()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, peer = self.listener.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)
+            if self.conn is not None:
+                print("Replacing detector connection", file=sys.stderr)
+                self.conn.close()
+            self.conn = conn
+            self.buffer = b""
+            print(f"Detector connected from {peer or 'local socket'}", file=sys.stderr)
+
+    def _receive(self):
+        try:
+            data = self.conn.recv(READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print(f"Detection stream read error: {e}", file=sys.stderr)
+            data = b""
+        if not data:
+            print("Detector disconnected", file=sys.stderr)
+            self.conn.close()
+            self.conn = None
+            self.buffer = b""
+            return
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        self.records.extend(line for line in lines if line.strip())
+
+    def read(self):
+        if self.listener is None:
+            try:
+                self.listener = listen_socket(self.address)
+                print(f"Listening for the detector on {self.address}", file=sys.stderr)
+            except OSError as e:
+                print(f"Error listening on {self.address}: {e}", file=sys.stderr)
+                return {}
+        self._accept()
+        if not self.records and self.conn is not None:
+            self._receive()
+        while self.records:
+            try:
+                return json.loads(self.records.popleft())
+            except json.JSONDecodeError as e:
+                print(f"Read error: {e}", file=sys.stderr)
+        return {}
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            remove_socket_file(self.address)
+
+    def fileno(self):
+        """Descriptor to wait on: the detector connection, or the listener until one connects."""
+        if self.conn is not None:
+            return self.conn.fileno()
+        return self.listener.fileno() if self.listener is not None else -1